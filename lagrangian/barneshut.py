@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Barnes-Hut quadtree for long range inverse distance potentials
+
+    U = coefficient * s_i * s_j / |q_i - q_j|
+
+summed over all the pairs, where s_i is the charge of q_i (its mass for
+gravity, with coefficient = -G). Cell lists are no use for these since every
+pair interacts, and doing every pair is O(N^2). The quadtree groups the far
+away particles of each q into a few nodes, each acting as a single charge at
+its center of charge, which makes the forces O(N log N).
+
+The tree is built and walked a level at a time with array operations, all
+the particles at once, rather than particle by particle.
+"""
+
+import numpy as np
+
+from lagrangian.celllists import _concatenated_ranges
+
+
+class QuadTree:
+    '''The quadtree of the (N, 2) array qs_array with charges, which must all have the same sign
+
+    Node 0 is the root, the smallest square holding all the qs. Each node with
+    more than one distinct q in it is split into the quarters that have qs in
+    them, up to max_depth levels, so coincident qs share a leaf. The nodes are stored as arrays indexed by node:
+
+        level, size         the level of the node and the side of its square
+        charge, center      the total charge and the center of charge
+        first_child, N_children
+                            the children of a node are the nodes
+                            first_child, ..., first_child + N_children - 1
+        is_leaf
+
+    and particle_nodes[L, a] is the node at level L that q_a is in
+    (-1 below the leaf q_a is in).
+    '''
+
+    max_depth = 32
+
+    def __init__(self, qs_array, charges):
+        self.qs_array = qs_array
+        self.charges = charges
+        N = len(qs_array)
+
+        corner = qs_array.min(axis = 0)
+        width = np.ptp(qs_array, axis = 0).max() * (1 + 1e-9) or 1.0
+
+        level, charge, center, is_leaf, first_child, N_children = [], [], [], [], [], []
+        particle_nodes = []
+
+        '''the root'''
+        nodes = np.zeros(N, dtype = int)
+        active = np.arange(N)
+        N_nodes = 0
+
+        for L in range(self.max_depth + 1):
+            if L > 0:
+                '''split the qs in the non-leaf nodes of the last level into quarters,
+                keyed by (parent, quarter) so the children of a node come out together'''
+                cells = np.floor((qs_array[active] - corner) / width * 2**L).astype(np.int64)
+                quarters = (cells[:, 0] & 1) * 2 + (cells[:, 1] & 1)
+                keys, nodes = np.unique(nodes * 4 + quarters, return_inverse = True)
+
+                parents, first, counts = np.unique(keys // 4, return_index = True, return_counts = True)
+                parents -= N_nodes - len(first_child[-1])
+                first_child[-1][parents] = N_nodes + first
+                N_children[-1][parents] = counts
+            else:
+                keys = np.zeros(1, dtype = np.int64)
+
+            N_level = len(keys)
+            counts = np.bincount(nodes, minlength = N_level)
+            level_charge = np.bincount(nodes, charges[active], minlength = N_level)
+            level_center = np.stack([np.bincount(nodes, charges[active] * qs_array[active, k],
+                                                 minlength = N_level)
+                                     for k in range(2)], axis = 1) / level_charge[:, np.newaxis]
+            level_lower = np.full((N_level, 2), np.inf)
+            level_upper = np.full((N_level, 2), -np.inf)
+            np.minimum.at(level_lower, nodes, qs_array[active])
+            np.maximum.at(level_upper, nodes, qs_array[active])
+            level_is_leaf = (level_lower == level_upper).all(axis = 1) | (L == self.max_depth)
+            '''a node of a single q, or of qs that all coincide, which no split would separate'''
+
+            level.append(np.full(N_level, L))
+            charge.append(level_charge)
+            center.append(level_center)
+            is_leaf.append(level_is_leaf)
+            first_child.append(np.zeros(N_level, dtype = int))
+            N_children.append(np.zeros(N_level, dtype = int))
+
+            particle_node = np.full(N, -1)
+            particle_node[active] = N_nodes + nodes
+            particle_nodes.append(particle_node)
+
+            N_nodes += N_level
+            '''only the qs in nodes that aren't leaves go on to the next level'''
+            still_splitting = ~level_is_leaf[nodes]
+            active, nodes = active[still_splitting], particle_node[active][still_splitting]
+            if len(active) == 0:
+                break
+
+        self.level = np.concatenate(level)
+        self.size = width / 2.0**self.level
+        self.charge = np.concatenate(charge)
+        self.center = np.concatenate(center)
+        self.is_leaf = np.concatenate(is_leaf)
+        self.first_child = np.concatenate(first_child)
+        self.N_children = np.concatenate(N_children)
+        self.particle_nodes = np.array(particle_nodes)
+
+
+    def forces(self, coefficient, opening_angle = 0.5, softening = 0):
+        '''The (N, 2) array of the forces of U = coefficient * s_i * s_j / sqrt(|q_i - q_j|^2 + softening^2)
+
+        Walks the tree from the root for all the qs at once. A node at distance
+        d from q acts as a single charge when size / d < opening_angle (and it
+        doesn't hold q), otherwise its children are looked at instead. Smaller
+        opening angles are more accurate and slower, 0 does every pair.
+        Two qs in the same leaf (they coincide, or very nearly at max_depth)
+        don't feel each other.
+        '''
+        qs_array, charges = self.qs_array, self.charges
+        N = len(qs_array)
+        forces = np.zeros((N, 2))
+
+        '''the (q, node) pairs still to look at'''
+        a = np.arange(N)
+        n = np.zeros(N, dtype = int)
+
+        while len(a):
+            r = qs_array[a] - self.center[n]
+            d2 = np.einsum('ij,ij->i', r, r) + softening**2
+
+            holds_q = self.particle_nodes[self.level[n], a] == n
+            far = self.size[n]**2 < opening_angle**2 * d2
+            accept = ~holds_q & (far | self.is_leaf[n])
+
+            '''the force on q from the accepted nodes'''
+            r, d2 = r[accept], d2[accept]
+            pair_forces = (coefficient * charges[a[accept]] * self.charge[n[accept]] / d2**1.5)[:, np.newaxis] * r
+            for k in range(2):
+                forces[:, k] += np.bincount(a[accept], pair_forces[:, k], minlength = N)
+
+            '''open up the rest'''
+            opened = ~accept & ~self.is_leaf[n]
+            a, n = a[opened], n[opened]
+            N_children = self.N_children[n]
+            a, n = np.repeat(a, N_children), _concatenated_ranges(self.first_child[n], N_children)
+
+        return forces
+
+
+
+def barnes_hut_forces(qs_array, charges, coefficient, opening_angle = 0.5, softening = 0):
+    '''the forces of the inverse distance potential, from a Barnes-Hut quadtree'''
+    return QuadTree(qs_array, charges).forces(coefficient, opening_angle, softening)
+
+
+def direct_forces(qs_array, charges, coefficient, opening_angle = None, softening = 0):
+    '''the forces of the inverse distance potential, summed over every pair.
+
+    O(N^2), for checking barnes_hut_forces and for small N. opening_angle is ignored.'''
+    i, j = np.triu_indices(len(qs_array), 1)
+    r = qs_array[i] - qs_array[j]
+    d2 = np.einsum('ij,ij->i', r, r) + softening**2
+
+    pair_forces = (coefficient * charges[i] * charges[j] / d2**1.5)[:, np.newaxis] * r
+    forces = np.zeros_like(qs_array, dtype = float)
+    for k in range(2):
+        forces[:, k] = np.bincount(i, pair_forces[:, k], minlength = len(qs_array)) \
+                     - np.bincount(j, pair_forces[:, k], minlength = len(qs_array))
+    return forces
+
+
+
+inverse_distance_solver_dict = {'barnes-hut': barnes_hut_forces,
+                                'direct': direct_forces
+                                }
@@ -17,7 +17,21 @@ from itertools import product
 import numpy as np
 
 
-from lagrangian.state import State
+from lagrangian.state import State, Coordinates
+from lagrangian.collisions import box_lengths, minimum_image
+
+
+forward_stencil = np.array([(1, -1), 
+                            (1, 0),
+                            (1, 1),
+                            (0, 1)])
+'''the offsets of the forward neighbor cells of a cell, as in forward_neighbor_cells'''
+
+
+def _concatenated_ranges(starts, counts):
+    '''the ranges starts[k], ..., starts[k] + counts[k] - 1 concatenated into one array'''
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
 
 
 def forward_neighbor_cells(i, j):
@@ -37,10 +51,18 @@ class CellLists:
         
         qs_cell[(i,j)]
         qs_forward_neighbor_cells[(i,j)] 
-        
+    
+    With periodic = True the region is a periodic box: there are no 
+    unbounded edge cells, the cells are taken mod N_x and N_y, and the 
+    forward neighbors of the cells on one edge are the cells on the opposite edge.
+    There must be at least 3 cells across for the forward neighbors to be
+    distinct, so at most a third of the box wide.
     '''
     
-    def __init__(self, xlim, suggested_dx, ylim, suggested_dy):
+    rebuild_every = 5
+    '''update rebuilds the neighbor pairs every rebuild_every calls'''
+    
+    def __init__(self, xlim, suggested_dx, ylim, suggested_dy, periodic = False):
         '''Initialize and start computing the cell lists. 
         
         Note that dx and 
@@ -48,6 +70,13 @@ class CellLists:
         the limits exactly.'''
         self.xlim = xlim
         self.ylim = ylim
+        self.periodic = periodic
+        self.box = box_lengths(xlim, ylim) if periodic else None
+        
+        self.N_updates = 0
+        self.N_rebuilds = 0
+        self.N_pairs_built = 0
+        '''metrics: how often the pairs were rebuilt and how many pairs in total'''
         
         
         
@@ -60,6 +89,9 @@ class CellLists:
         
         self.cell_lists = dict()
         
+        self.N_cells = self.N_x * self.N_y
+        self.forward_neighbor_cell_table = self._forward_neighbor_cell_table()
+        
         
         
         
@@ -71,6 +103,12 @@ class CellLists:
         N_y_inside_boundary = math.floor((self.ylim[1]-self.ylim[0]) / suggested_dy)
         dy = (self.ylim[1]-self.ylim[0]) / N_y_inside_boundary 
         
+        if self.periodic:
+            if min(N_x_inside_boundary, N_y_inside_boundary) < 3:
+                raise ValueError('periodic cell lists need at least 3 cells across, got ', 
+                                 (N_x_inside_boundary, N_y_inside_boundary))
+            return dx, N_x_inside_boundary, dy, N_y_inside_boundary
+        
         N_x, N_y = N_x_inside_boundary + 2, N_y_inside_boundary + 2
         #because we are going to add a single unbouded cell containing all x's to the left of xlim[0]
         # and similarly for above x[1] and for the y's.
@@ -82,6 +120,10 @@ class CellLists:
     def cell_of_q(self, q):
         '''returns the index (i,j) of the cell q = np.array of dim 2 resides in'''
         xlim, dx, ylim, dy = self.xlim, self.dx, self.ylim, self.dy
+        if self.periodic:
+            return (math.floor((q[0]-xlim[0])/dx) % self.N_x, 
+                    math.floor((q[1]-ylim[0])/dy) % self.N_y)
+        
         cell_x = math.floor((q[0]-xlim[0])/dx) + 1
         ''''the following logic speels out what happens if the q is outside the defined region'''
         if cell_x <= 0:
@@ -97,6 +139,61 @@ class CellLists:
         return (cell_x, cell_y)
     
     
+    def cells_of_qs(self, qs_array):
+        '''cell_of_q for every row of the (N, 2) array qs_array at once. 
+        
+        Returns the flat cell ids cell_x * N_y + cell_y'''
+        cell_x = np.floor((qs_array[:, 0] - self.xlim[0]) / self.dx).astype(int)
+        cell_y = np.floor((qs_array[:, 1] - self.ylim[0]) / self.dy).astype(int)
+        
+        if self.periodic:
+            return (cell_x % self.N_x) * self.N_y + cell_y % self.N_y
+        
+        cell_x, cell_y = cell_x + 1, cell_y + 1
+        cell_x = np.clip(cell_x, 0, self.N_x - 1)
+        cell_y = np.clip(cell_y, 0, self.N_y - 1)
+        return cell_x * self.N_y + cell_y
+    
+    
+    def _forward_neighbor_cell_table(self):
+        '''table[c, k] is the flat id of the cell at forward_stencil[k] from cell c, or -1 if there is none'''
+        cell_x, cell_y = np.divmod(np.arange(self.N_cells), self.N_y)
+        
+        table = np.full((self.N_cells, len(forward_stencil)), -1)
+        for k, (offset_x, offset_y) in enumerate(forward_stencil):
+            neighbor_x, neighbor_y = cell_x + offset_x, cell_y + offset_y
+            if self.periodic:
+                neighbor_x, neighbor_y = neighbor_x % self.N_x, neighbor_y % self.N_y
+            inside = (0 <= neighbor_x) & (neighbor_x < self.N_x) & \
+                     (0 <= neighbor_y) & (neighbor_y < self.N_y)
+            table[inside, k] = neighbor_x[inside] * self.N_y + neighbor_y[inside]
+        return table
+    
+    
+    def generate_linked_cells(self, qs_array):
+        '''The array version of the cell lists, built by a counting sort of the cell ids
+        
+        Computes and stores
+            cells[a]        the cell of row a of qs_array
+            sorted_rows     the rows sorted by cell, so the rows in cell c are
+                            sorted_rows[cell_start[c] : cell_start[c] + cell_count[c]]
+            cell_start, cell_count
+            position[a]     where row a is in sorted_rows
+        '''
+        self.cells = self.cells_of_qs(qs_array)
+        
+        self.cell_count = np.bincount(self.cells, minlength = self.N_cells)
+        self.cell_start = np.cumsum(self.cell_count) - self.cell_count
+        
+        sort_type = np.uint16 if self.N_cells <= 2**16 else np.int64
+        '''numpy sorts 16 bit integers stably with a radix sort, which is O(N)'''
+        self.sorted_rows = np.argsort(self.cells.astype(sort_type), kind = 'stable')
+        
+        self.position = np.empty_like(self.sorted_rows)
+        self.position[self.sorted_rows] = np.arange(len(self.sorted_rows))
+        return self.sorted_rows
+    
+    
     def _generate_cell_lists(self, state):
         '''This function generates the cell lists cell_lists[(i,j)] 
          
@@ -143,6 +240,138 @@ class CellLists:
                 if p>q:
                     self.forward_neighbor_lists[q].append(p)
         return self.forward_neighbor_lists
+    
+    
+    def generate_forward_neighbor_pairs(self, state):
+        '''Returns the pairs of forward neighbors as two arrays i, j of rows in the Coordinates arrays
+        
+        (state.qs.array[i[m]], state.qs.array[j[m]]) runs over the same pairs 
+        as forward_neighbor_lists, each pair once: the pairs in the same cell,
+        and the pairs in a cell and one of its forward neighbor cells. 
+        These come straight from the linked cells, with no per particle Python.
+        '''
+        self.generate_linked_cells(state.qs.array)
+        cells, position = self.cells, self.position
+        rows = np.arange(len(cells))
+        
+        '''pairs in the same cell: each row with the rows after it in sorted_rows'''
+        N_after = self.cell_start[cells] + self.cell_count[cells] - 1 - position
+        i = [np.repeat(rows, N_after)]
+        j = [self.sorted_rows[_concatenated_ranges(position + 1, N_after)]]
+        
+        for k in range(len(forward_stencil)):
+            neighbor_cells = self.forward_neighbor_cell_table[cells, k]
+            N_neighbors = np.where(neighbor_cells >= 0, self.cell_count[neighbor_cells], 0)
+            
+            i.append(np.repeat(rows, N_neighbors))
+            j.append(self.sorted_rows[_concatenated_ranges(self.cell_start[neighbor_cells], 
+                                                           N_neighbors)])
+        
+        self.forward_neighbor_pairs = np.concatenate(i), np.concatenate(j)
+        return self.forward_neighbor_pairs
+    
+    
+    def update(self, state):
+        '''Called by the dynamics every step. Returns the forward neighbor pairs,
+        rebuilding them when needs_rebuild says so'''
+        if self.needs_rebuild(state):
+            self.generate_forward_neighbor_pairs(state)
+            self.N_rebuilds += 1
+            self.N_pairs_built += len(self.forward_neighbor_pairs[0])
+        self.N_updates += 1
+        return self.forward_neighbor_pairs
+    
+    
+    def needs_rebuild(self, state):
+        return self.N_updates % self.rebuild_every == 0
+    
+    
+    @property
+    def average_N_pairs(self):
+        '''the average length of the neighbor pair list over the rebuilds'''
+        return self.N_pairs_built / max(self.N_rebuilds, 1)
+        
+        
+class VerletLists(CellLists):
+    '''Verlet neighbor lists: the pairs closer than cutoff + skin, found with cell lists
+    
+    The cells are at least cutoff + skin wide, so the cell-list pairs include
+    every pair closer than that, and the list keeps only those. As long as no 
+    particle has moved more than skin / 2 since the list was built, every pair 
+    closer than cutoff is still in it, so update only rebuilds once some 
+    particle has. That is rarely in a slow, dense fluid, and as often as 
+    needed in a fast splash.
+    
+    Pairs between cutoff and cutoff + skin are in the list too, so the pair 
+    potentials should be negligible beyond cutoff.
+    '''
+    
+    def __init__(self, xlim, ylim, cutoff, skin, periodic = False):
+        super().__init__(xlim, cutoff + skin, ylim, cutoff + skin, periodic)
+        self.cutoff = cutoff
+        self.skin = skin
+        self.built_qs = None
+        
+        
+    def generate_forward_neighbor_pairs(self, state):
+        i, j = super().generate_forward_neighbor_pairs(state)
+        
+        qs_array = state.qs.array
+        r = qs_array[i] - qs_array[j]
+        if self.periodic:
+            r = minimum_image(r, self.box)
+        close = np.einsum('ij,ij->i', r, r) < (self.cutoff + self.skin)**2
+        
+        self.built_qs = qs_array.copy()
+        self.forward_neighbor_pairs = i[close], j[close]
+        return self.forward_neighbor_pairs
+    
+    
+    def needs_rebuild(self, state):
+        if self.built_qs is None:
+            return True
+        displacements = state.qs.array - self.built_qs
+        if self.periodic:
+            displacements = minimum_image(displacements, self.box)
+        max_displacement_squared = np.einsum('ij,ij->i', displacements, displacements).max(initial = 0)
+        return max_displacement_squared > (self.skin / 2)**2
+        
+        
+class EnsembleNeighborLists:
+    '''The neighbor lists of each replica of an ensemble, with the pairs of all of them together
+    
+    The qs of the ensemble are an (M, N, dim) array, and the pairs number the 
+    rows of replica m from m * N, as in the (M * N, dim) array of all the qs.
+    '''
+    
+    def __init__(self, neighbor_lists):
+        self.neighbor_lists = neighbor_lists
+        self.forward_neighbor_pairs = None
+        
+        
+    def update(self, state):
+        qs_array, q_dots_array = state.qs.array, state.q_dots.array
+        N = qs_array.shape[1]
+        
+        N_rebuilds = self.N_rebuilds
+        pairs = [neighbor_lists.update(State.from_arrays(qs_array[m], q_dots_array[m]))
+                 for m, neighbor_lists in enumerate(self.neighbor_lists)]
+        
+        if self.forward_neighbor_pairs is None or self.N_rebuilds != N_rebuilds:
+            self.forward_neighbor_pairs = tuple(np.concatenate([pair[k] + m * N for m, pair in enumerate(pairs)])
+                                                for k in range(2))
+        return self.forward_neighbor_pairs
+    
+    
+    @property
+    def N_rebuilds(self):
+        return sum(neighbor_lists.N_rebuilds for neighbor_lists in self.neighbor_lists)
+    
+    
+    @property
+    def average_N_pairs(self):
+        '''the average length of the neighbor pair list of a replica over the rebuilds'''
+        return sum(neighbor_lists.N_pairs_built for neighbor_lists in self.neighbor_lists) / max(self.N_rebuilds, 1)
         
         
 if __name__=='__main__':
@@ -6,6 +6,7 @@ Created on Sun Dec 27 17:15:39 2020
 @author: robertdenomme
 """
 
+import numpy as np
 
 from lagrangian.state import State, Coordinates
 
@@ -15,34 +16,90 @@ def resolve_wall_collisions(state,
                             xlim = (-10, 10), 
                             ylim = (-10, 10),
                             wall_elasticity = 1):
-    new_state = state.copy()
+    qs, q_dots = reflect_off_walls(state.qs.array, state.q_dots.array, xlim, ylim, wall_elasticity)
+    if qs is state.qs.array:
+        '''nothing hit a wall, so the state (and any fsal_slope the integrator 
+        left on it) stays as it is'''
+        return state
+    
+    return State.from_arrays(qs, q_dots)
+
+
+def reflect_off_walls(qs, q_dots, 
+                      xlim = (-10, 10), 
+                      ylim = (-10, 10),
+                      wall_elasticity = 1):
+    '''resolve_wall_collisions for the arrays of the qs and q_dots, returns the new arrays
+    
+    When nothing hit a wall these are the same arrays, not copies.'''
+    lower = np.array([xlim[0], ylim[0]])
+    upper = np.array([xlim[1], ylim[1]])
+    if np.all((lower <= qs) & (qs <= upper)):
+        return qs, q_dots
     
     eps = .0001
     e = wall_elasticity
     
-    qs = new_state.qs
-    q_dots = new_state.q_dots
-    
-    for i, q in qs.items():
-        if q[0] < xlim[0]:
-            qs[i][0] = xlim[0]+eps
-            if q_dots[i][0] < 0:
-                q_dots[i][0] = - e * q_dots[i][0]
-        
-        elif q[0] > xlim[1]:
-            qs[i][0] = xlim[1]-eps
-            if q_dots[i][0] > 0:
-                q_dots[i][0] = - e * q_dots[i][0]
-        
-        
-        if q[1] < ylim[0]:
-            qs[i][1] = ylim[0]+eps
-            if q_dots[i][1] < 0:
-                q_dots[i][1] = - e * q_dots[i][1]
-        
-        elif q[1] > ylim[1]:
-            qs[i][1] = ylim[1]-eps
-            if q_dots[i][1] > 0:
-                q_dots[i][1] = - e * q_dots[i][1]
-    
-    return State(qs, q_dots)
\ No newline at end of file
+    qs = qs.copy()
+    q_dots = q_dots.copy()
+    '''all the coordinates (of all the replicas of an ensemble) at once, 
+    each component bouncing off its own pair of walls'''
+    
+    below = qs < lower
+    qs[below] = np.broadcast_to(lower + eps, qs.shape)[below]
+    q_dots[below & (q_dots < 0)] *= - e
+    
+    above = qs > upper
+    qs[above] = np.broadcast_to(upper - eps, qs.shape)[above]
+    q_dots[above & (q_dots > 0)] *= - e
+    
+    return qs, q_dots
+
+
+
+integrator_caches = ('fsal_slope', 'respa_accelerations', 'q_dotdots')
+'''what integrators leave on a state for their next step. These only depend 
+on the qs through the forces, so wrap_periodic carries them over'''
+
+
+def box_lengths(xlim = (-10, 10), ylim = (-10, 10)):
+    '''the side lengths of the periodic box xlim x ylim, as an array'''
+    return np.array([xlim[1] - xlim[0], ylim[1] - ylim[0]], dtype = float)
+
+
+def minimum_image(r, box):
+    '''The shortest of the periodic images of the displacements r
+    
+    r is a displacement q - p, or an (M, 2) array of them, and box is 
+    box_lengths(xlim, ylim). Each component is shifted by a multiple of the 
+    box length into [-L/2, L/2].'''
+    return r - box * np.round(r / box)
+
+
+def wrap_periodic(state, 
+                  xlim = (-10, 10), 
+                  ylim = (-10, 10),
+                  wall_elasticity = 1):
+    '''Periodic boundary: a particle leaving the box comes back in on the opposite side
+    
+    The velocities are unchanged. wall_elasticity is ignored, it is only 
+    accepted so the boundaries in boundary_dict can be called alike.'''
+    wrapped_state = State.from_arrays(wrap_into_box(state.qs.array, xlim, ylim), state.q_dots.array.copy())
+    for name in integrator_caches:
+        if hasattr(state, name):
+            '''the forces are periodic, so what the integrator left on the 
+            state is the same at the wrapped qs'''
+            setattr(wrapped_state, name, getattr(state, name))
+    return wrapped_state
+
+
+def wrap_into_box(qs, xlim = (-10, 10), ylim = (-10, 10)):
+    '''the periodic images of the qs inside the box xlim x ylim'''
+    lower = np.array([xlim[0], ylim[0]], dtype = float)
+    return lower + np.mod(qs - lower, box_lengths(xlim, ylim))
+
+
+
+boundary_dict = {'walls': resolve_wall_collisions,
+                 'periodic': wrap_periodic
+                 }
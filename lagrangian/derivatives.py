@@ -15,6 +15,13 @@ f = derivatives.add_partials(f)
 
 f.partial[0](1,1,1,G=4)
 f.partial['G'](1,1,1,G=4)
+
+Gradients U.gradient[i] are computed exactly with forward-mode automatic 
+differentiation (see Dual below) whenever U is written with numpy operations, 
+and with difference quotients otherwise. Set U.autodiff = False to always use 
+difference quotients. That is only ever read: when U can't be evaluated on 
+Duals, the gradient that found out switches to difference quotients on its own
+(see AutodiffSwitch), and U is left alone.
 """
 
 import numpy as np
@@ -143,6 +150,370 @@ variables q which themselves have multiple variables q = (x,y,z)
 
 
 
+'''Forward-mode automatic differentiation.
+
+A Dual holds a value (a float or numpy array) along with its derivatives in 
+n directions, stored in the last axis of derivative, so 
+    derivative.shape == np.shape(value) + (n,)
+Evaluating a potential U(q1, q2, ...) on Duals seeded with the identity 
+matrix gives all its partial derivatives in one evaluation, without any of the
+step size trouble of difference quotients. numpy ufuncs, np.dot, np.sum and 
+np.linalg.norm all work on Duals.
+'''
+
+
+def _dual_parts(x):
+    '''splits x into value and derivative, with derivative None for constants'''
+    if isinstance(x, Dual):
+        return x.value, x.derivative
+    return x, None
+
+
+def _times(factor, derivative):
+    '''the derivative of a function with the given derivative factor, by the chain rule'''
+    if derivative is None:
+        return None
+    return np.asarray(factor)[..., np.newaxis] * derivative
+
+
+def _column(x):
+    '''x with a new last axis, so it multiplies derivatives elementwise'''
+    if isinstance(x, np.ndarray) and x.ndim:
+        return x[..., np.newaxis]
+    return x
+
+
+def _plus(d_1, d_2):
+    if d_1 is None:
+        return d_2
+    if d_2 is None:
+        return d_1
+    return d_1 + d_2
+
+
+def _unary_derivative_factors():
+    '''the derivative of each supported unary ufunc, as a function of its input x'''
+    return {
+        np.negative: lambda x: -np.ones_like(x),
+        np.positive: lambda x: np.ones_like(x),
+        np.sqrt: lambda x: 0.5 / np.sqrt(x),
+        np.square: lambda x: 2 * x,
+        np.exp: np.exp,
+        np.log: lambda x: 1 / x,
+        np.sin: np.cos,
+        np.cos: lambda x: -np.sin(x),
+        np.tan: lambda x: np.cos(x)**-2,
+        np.arcsin: lambda x: 1 / np.sqrt(1 - x**2),
+        np.arccos: lambda x: -1 / np.sqrt(1 - x**2),
+        np.arctan: lambda x: 1 / (1 + x**2),
+        np.sinh: np.cosh,
+        np.cosh: np.sinh,
+        np.tanh: lambda x: 1 - np.tanh(x)**2,
+        np.absolute: np.sign,
+        }
+
+
+class Dual:
+    '''A value together with its derivatives, for forward-mode autodiff. See above.'''
+    
+    unary_derivative_factors = _unary_derivative_factors()
+    
+    constant_ufuncs = {np.sign, np.floor, np.ceil, np.rint, 
+                       np.greater, np.greater_equal, np.less, np.less_equal,
+                       np.equal, np.not_equal}
+    '''ufuncs with zero derivative; they just act on the values'''
+    
+    __slots__ = ('value', 'derivative')
+    
+    def __init__(self, value, derivative):
+        self.value = value
+        self.derivative = derivative
+    
+    
+    @property
+    def shape(self):
+        return np.shape(self.value)
+    
+    @property
+    def ndim(self):
+        return np.ndim(self.value)
+    
+    def __len__(self):
+        return len(self.value)
+    
+    def __getitem__(self, key):
+        '''the derivative takes the same key plus all of its last axis, so
+        keys with an Ellipsis (q[..., 0]) never index the directions'''
+        key = key if isinstance(key, tuple) else (key,)
+        return Dual(self.value[key], self.derivative[key + (slice(None),)])
+    
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+    
+    def __repr__(self):
+        return 'Dual(' + repr(self.value) + ', ' + repr(self.derivative) + ')'
+    
+    
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs:
+            return NotImplemented
+        if ufunc is np.matmul:
+            return _dual_dot(*inputs)
+        
+        values = [_dual_parts(x)[0] for x in inputs]
+        derivatives = [_dual_parts(x)[1] for x in inputs]
+        value = ufunc(*values)
+        
+        if ufunc in self.constant_ufuncs:
+            return value
+        
+        if ufunc in self.unary_derivative_factors:
+            (x,), (d_x,) = values, derivatives
+            derivative = _times(self.unary_derivative_factors[ufunc](x), d_x)
+        
+        elif ufunc is np.add:
+            derivative = _plus(*derivatives)
+        
+        elif ufunc is np.subtract:
+            derivative = _plus(derivatives[0], _times(-1, derivatives[1]))
+        
+        elif ufunc is np.multiply:
+            (x, y), (d_x, d_y) = values, derivatives
+            derivative = _plus(_times(y, d_x), _times(x, d_y))
+        
+        elif ufunc is np.true_divide:
+            (x, y), (d_x, d_y) = values, derivatives
+            derivative = _plus(_times(1 / y, d_x), _times(- x / y**2, d_y))
+        
+        elif ufunc is np.power:
+            (x, y), (d_x, d_y) = values, derivatives
+            derivative = None
+            if d_x is not None:
+                derivative = _times(y * x**(y - 1), d_x)
+            if d_y is not None:
+                derivative = _plus(derivative, _times(value * np.log(x), d_y))
+        
+        elif ufunc is np.arctan2:
+            (y, x), (d_y, d_x) = values, derivatives
+            r_squared = x**2 + y**2
+            derivative = _plus(_times(x / r_squared, d_y), _times(- y / r_squared, d_x))
+        
+        else:
+            return NotImplemented
+        
+        if derivative.shape[:-1] != np.shape(value):
+            derivative = np.broadcast_to(derivative, np.shape(value) + derivative.shape[-1:])
+        return Dual(value, derivative)
+    
+    
+    def __array_function__(self, func, types, args, kwargs):
+        if func is np.dot:
+            return _dual_dot(*args, **kwargs)
+        if func is np.sum:
+            return _dual_sum(*args, **kwargs)
+        if func is np.linalg.norm:
+            return _dual_norm(*args, **kwargs)
+        return NotImplemented
+    
+    
+    '''The arithmetic operators below handle the common cases, another Dual or a 
+    constant which doesn't change the shape, directly. That skips the ufunc 
+    machinery, which matters since a potential is mostly scalar arithmetic 
+    once the distances are computed. Everything else goes through the ufuncs.'''
+    
+    def _fits(self, other):
+        '''True if combining self with the constant array other keeps the shape of self'''
+        return np.shape(other) in ((), np.shape(self.value))
+    
+    def __add__(self, other):
+        if isinstance(other, (int, float)):
+            return Dual(self.value + other, self.derivative)
+        if type(other) is Dual:
+            return Dual(self.value + other.value, self.derivative + other.derivative)
+        if self._fits(other):
+            return Dual(self.value + other, self.derivative)
+        return np.add(self, other)
+    
+    __radd__ = __add__
+    
+    def __sub__(self, other):
+        if isinstance(other, (int, float)):
+            return Dual(self.value - other, self.derivative)
+        if type(other) is Dual:
+            return Dual(self.value - other.value, self.derivative - other.derivative)
+        if self._fits(other):
+            return Dual(self.value - other, self.derivative)
+        return np.subtract(self, other)
+    
+    def __rsub__(self, other):
+        if isinstance(other, (int, float)) or self._fits(other):
+            return Dual(other - self.value, -self.derivative)
+        return np.subtract(other, self)
+    
+    def __mul__(self, other):
+        if isinstance(other, (int, float)):
+            return Dual(self.value * other, self.derivative * other)
+        if type(other) is Dual:
+            return Dual(self.value * other.value, 
+                        self.derivative * _column(other.value) + _column(self.value) * other.derivative)
+        if self._fits(other):
+            return Dual(self.value * other, self.derivative * _column(other))
+        return np.multiply(self, other)
+    
+    __rmul__ = __mul__
+    
+    def __truediv__(self, other):
+        if isinstance(other, (int, float)):
+            return Dual(self.value / other, self.derivative / other)
+        if type(other) is Dual:
+            value = self.value / other.value
+            return Dual(value, 
+                        (self.derivative - _column(value) * other.derivative) / _column(other.value))
+        if self._fits(other):
+            return Dual(self.value / other, self.derivative / _column(other))
+        return np.true_divide(self, other)
+    
+    def __rtruediv__(self, other):
+        if isinstance(other, (int, float)) or self._fits(other):
+            value = other / self.value
+            return Dual(value, - _column(value / self.value) * self.derivative)
+        return np.true_divide(other, self)
+    
+    def __pow__(self, other):
+        if isinstance(other, (int, float)):
+            return Dual(self.value**other, 
+                        _column(other * self.value**(other - 1)) * self.derivative)
+        return np.power(self, other)
+    
+    def __rpow__(self, other): return np.power(other, self)
+    
+    def __neg__(self): return Dual(-self.value, -self.derivative)
+    
+    def __matmul__(self, other): return np.matmul(self, other)
+    def __rmatmul__(self, other): return np.matmul(other, self)
+    def __pos__(self): return self
+    def __abs__(self): return np.absolute(self)
+    
+    def __lt__(self, other): return np.less(self, other)
+    def __le__(self, other): return np.less_equal(self, other)
+    def __gt__(self, other): return np.greater(self, other)
+    def __ge__(self, other): return np.greater_equal(self, other)
+
+
+def _dual_dot(a, b):
+    if np.ndim(_dual_parts(a)[0]) == 0 or np.ndim(_dual_parts(b)[0]) == 0:
+        return np.multiply(a, b)
+    
+    (x, d_x), (y, d_y) = _dual_parts(a), _dual_parts(b)
+    value = np.dot(x, y)
+    
+    if np.ndim(x) == 1 and np.ndim(y) == 1:
+        '''the usual dot product of two vectors'''
+        derivative = None if d_x is None else np.dot(y, d_x)
+        return Dual(value, derivative if d_y is None else _plus(derivative, np.dot(x, d_y)))
+    
+    derivative = None
+    if d_x is not None:
+        '''contract the last value axis of x with the first (1-d) or second to last axis of y'''
+        d = np.tensordot(d_x, y, axes = ([d_x.ndim - 2], [max(np.ndim(y) - 2, 0)]))
+        derivative = np.moveaxis(d, np.ndim(x) - 1, -1)
+    if d_y is not None:
+        d = np.tensordot(x, d_y, axes = ([np.ndim(x) - 1], [max(np.ndim(y) - 2, 0)]))
+        derivative = _plus(derivative, d)
+    return Dual(value, derivative)
+
+
+def _dual_sum(a, axis = None):
+    x, d_x = _dual_parts(a)
+    if axis is None:
+        return Dual(np.sum(x), d_x.reshape(-1, d_x.shape[-1]).sum(axis = 0))
+    
+    axes = (axis,) if np.ndim(axis) == 0 else tuple(axis)
+    axes = tuple(a % np.ndim(x) for a in axes)
+    '''negative axes count from the end of the value, not of the derivative'''
+    return Dual(np.sum(x, axis = axes), d_x.sum(axis = axes))
+
+
+def _dual_norm(a, ord = None, axis = None):
+    if ord is not None:
+        raise TypeError('only the 2-norm of a Dual is supported')
+    if axis is None and a.ndim == 1:
+        '''the length of a vector, the usual case'''
+        value = math.sqrt(np.dot(a.value, a.value))
+        return Dual(value, np.dot(a.value, a.derivative) / value)
+    return np.sqrt(_dual_sum(a * a, axis = axis))
+
+
+autodiff_errors = (TypeError, AttributeError, ValueError)
+'''errors meaning a function can't be evaluated on Duals (it uses math.sqrt, say).
+The gradients of functions raising them fall back to difference quotients 
+from then on, see AutodiffSwitch.'''
+
+
+class AutodiffSwitch:
+    '''Whether to keep trying automatic differentiation on U, for one owner
+    
+    Each gradient function (and each Gradient or PotentialSet, which pass it 
+    on) keeps its own switch, turned off by the first evaluation that can't be
+    done on Duals. So a failure only sends its owner to difference quotients,
+    not every other use of U. It starts off if U.autodiff is False.'''
+    
+    def __init__(self, U):
+        self.on = getattr(U, 'autodiff', True) is not False
+
+
+@functools.lru_cache(maxsize = None)
+def _seeds(dim, m):
+    '''the derivatives of m coordinates of dimension dim wrt. all m * dim components
+    
+    These are blocks of the identity matrix, shared between calls, so they are read-only.'''
+    identity = np.eye(dim * m)
+    seeds = tuple(identity[k * dim:(k + 1) * dim] for k in range(m))
+    for seed in seeds:
+        seed.flags.writeable = False
+    return seeds
+
+
+def dual_gradients(U, args, indices, **kwargs):
+    '''Returns the gradients of U wrt. args[i], for i in indices, from one evaluation
+    
+    The args[i] are replaced by Duals seeded with the identity, so that 
+    U(*args, **kwargs) carries the partial derivatives wrt. every component 
+    of every args[i]. The result has shape (len(indices), dim), where dim is 
+    the dimension of the coordinates.
+    '''
+    args = list(args)
+    dim = np.size(args[indices[0]])
+    
+    for i, seed in zip(indices, _seeds(dim, len(indices))):
+        args[i] = Dual(np.asarray(args[i], dtype = float), seed)
+    
+    U_value = U(*args, **kwargs)
+    if not isinstance(U_value, Dual) or np.ndim(U_value.value) != 0:
+        raise TypeError('U did not return a scalar Dual')
+    
+    return U_value.derivative.reshape(len(indices), dim)
+
+
+def dual_jacobian(F, args, **kwargs):
+    '''Returns the Jacobian of F wrt. all its args, from one evaluation
+    
+    F returns a sequence of vectors of the dimension of the args (a gradient,
+    say), and the result is the (len(F(*args)) * dim, len(args) * dim) array of
+    the derivatives of each of their components wrt. each component of the args.
+    '''
+    dim = np.size(args[0])
+    args = [Dual(np.asarray(arg, dtype = float), seed) 
+            for arg, seed in zip(args, _seeds(dim, len(args)))]
+    
+    F_value = F(*args, **kwargs)
+    if isinstance(F_value, Dual):
+        return F_value.derivative.reshape(-1, len(args) * dim)
+    if not all(isinstance(F_i, Dual) for F_i in F_value):
+        raise TypeError('F did not return Duals')
+    return np.concatenate([F_i.derivative.reshape(-1, len(args) * dim) for F_i in F_value])
+
+
 def two_d_gradient(f, q):
     '''Returns the value of gradient of the function f at the point q.
     
@@ -161,10 +532,28 @@ def two_d_gradient(f, q):
     return np.array([f_x, f_y])
     
 
-def get_gradient_i(U, i):
+def get_gradient_i(U, i, full_gradient = None, autodiff = None):
+    '''full_gradient is an analytic gradient of U, see add_analytic_gradient. 
+    It defaults to U.full_gradient if U has been decorated with one. autodiff
+    is the AutodiffSwitch of the owner, a new one by default'''
+    full_gradient = full_gradient or getattr(U, 'full_gradient', None)
+    autodiff = autodiff or AutodiffSwitch(U)
+    
     def U_gradient_i(*args, **kwargs):
         '''returns a function which gives the gradient of U wrt. qi at the input determined by *args, **kwargs
         '''
+        if full_gradient is not None:
+            return np.asarray(full_gradient(*args, **kwargs), dtype = float)[i]
+        
+        if autodiff.on:
+            try:
+                return dual_gradients(U, args, [i], **kwargs)[0]
+            except (FloatingPointError, ZeroDivisionError):
+                '''singular derivative here, e.g. of a norm at 0. Difference quotients cope with that'''
+                pass
+            except autodiff_errors:
+                autodiff.on = False
+        
         def U_restricted_i(*args, **kwargs):
             '''Returns a function of a signel variable q=qi (ignoring the value of qi passed in)
             
@@ -190,6 +579,116 @@ def get_gradient_i(U, i):
         
         
 
+def get_full_gradient(U, full_gradient = None, autodiff = None):
+    '''full_gradient is an analytic gradient of U and autodiff an AutodiffSwitch, as in get_gradient_i'''
+    full_gradient = full_gradient or getattr(U, 'full_gradient', None)
+    autodiff = autodiff or AutodiffSwitch(U)
+    
+    def U_full_gradient(*args, **kwargs):
+        '''returns the gradients of U wrt. all its positional args at once, as an (n_args, dim) array
+        
+        An analytic gradient is used if there is one. With automatic 
+        differentiation this is a single evaluation of U. Otherwise the rows 
+        come from get_gradient_i one at a time.
+        '''
+        if full_gradient is not None:
+            return np.asarray(full_gradient(*args, **kwargs), dtype = float)
+        
+        if autodiff.on:
+            try:
+                return dual_gradients(U, args, list(range(len(args))), **kwargs)
+            except (FloatingPointError, ZeroDivisionError):
+                pass
+            except autodiff_errors:
+                autodiff.on = False
+        
+        return np.array([get_gradient_i(U, i, autodiff = autodiff)(*args, **kwargs) for i in range(len(args))])
+    
+    return U_full_gradient
+
+
+def rowwise_gradient(U, r, full_gradient = None, autodiff = None, **kwargs):
+    '''Returns the gradient of U(r)[m] wrt. r[m] for every row m, as an (M, dim) array
+    
+    This is for vectorized functions U, taking an (M, dim) array r (of pair 
+    displacements, say) to the (M,) array of values U(r[m]). One evaluation on 
+    a Dual seeded with the identity in every row gives all M gradients. 
+    Otherwise they come from central difference quotients, evaluating U on 
+    all the rows at once. full_gradient is an optional analytic gradient, 
+    taking r to the (M, dim) array of gradients, and autodiff the 
+    AutodiffSwitch of the caller.
+    '''
+    full_gradient = full_gradient or getattr(U, 'full_gradient', None)
+    if full_gradient is not None:
+        return np.asarray(full_gradient(r, **kwargs), dtype = float)
+    
+    M, dim = r.shape
+    autodiff = autodiff or AutodiffSwitch(U)
+    if autodiff.on:
+        try:
+            seed = np.broadcast_to(np.eye(dim), (M, dim, dim))
+            U_value = U(Dual(r, seed), **kwargs)
+            if isinstance(U_value, Dual) and U_value.derivative.shape == (M, dim):
+                return U_value.derivative
+            autodiff.on = False
+        except (FloatingPointError, ZeroDivisionError):
+            pass
+        except autodiff_errors:
+            autodiff.on = False
+    
+    h = math.sqrt(np.finfo(float).eps) * np.maximum(np.abs(r), 1)
+    gradient = np.empty((M, dim))
+    for k in range(dim):
+        r_plus, r_minus = r.copy(), r.copy()
+        r_plus[:, k] += h[:, k]
+        r_minus[:, k] -= h[:, k]
+        gradient[:, k] = (U(r_plus, **kwargs) - U(r_minus, **kwargs)) / (r_plus[:, k] - r_minus[:, k])
+    return gradient
+
+
+def batched_full_gradient(U, args, full_gradient = None, autodiff = None, **kwargs):
+    '''Returns the gradients of U wrt. all its args for a batch of M evaluations, as an (n_args, M, dim) array
+    
+    The args are (M, dim) arrays, and U is vectorized: it takes them to the 
+    (M,) array of the values of U on their rows m (using axis = -1 in its norms
+    and sums, say). As in rowwise_gradient, one evaluation on Duals gives all 
+    the gradients, and difference quotients evaluate U on all M rows at once. 
+    full_gradient is an optional analytic gradient, returning the 
+    (n_args, M, dim) array, and autodiff the AutodiffSwitch of the caller.
+    '''
+    full_gradient = full_gradient or getattr(U, 'full_gradient', None)
+    if full_gradient is not None:
+        return np.asarray(full_gradient(*args, **kwargs), dtype = float)
+    
+    n = len(args)
+    M, dim = args[0].shape
+    autodiff = autodiff or AutodiffSwitch(U)
+    if autodiff.on:
+        try:
+            dual_args = [Dual(arg, np.broadcast_to(seed, (M, dim, n * dim))) 
+                         for arg, seed in zip(args, _seeds(dim, n))]
+            U_value = U(*dual_args, **kwargs)
+            if isinstance(U_value, Dual) and U_value.derivative.shape == (M, n * dim):
+                return U_value.derivative.reshape(M, n, dim).transpose(1, 0, 2)
+            autodiff.on = False
+        except (FloatingPointError, ZeroDivisionError):
+            pass
+        except autodiff_errors:
+            autodiff.on = False
+    
+    gradients = np.empty((n, M, dim))
+    for i in range(n):
+        h = math.sqrt(np.finfo(float).eps) * np.maximum(np.abs(args[i]), 1)
+        for k in range(dim):
+            args_plus, args_minus = list(args), list(args)
+            args_plus[i], args_minus[i] = args[i].copy(), args[i].copy()
+            args_plus[i][:, k] += h[:, k]
+            args_minus[i][:, k] -= h[:, k]
+            gradients[i, :, k] = (U(*args_plus, **kwargs) - U(*args_minus, **kwargs)) / \
+                                 (args_plus[i][:, k] - args_minus[i][:, k])
+    return gradients
+
+
 def get_gradient_functions(U):
     ''' Assuming U is a function of coordinates q1, q2, this function adds gradients wrt these coords
     
@@ -219,6 +718,26 @@ def get_gradient_functions(U):
 
 
 
+def add_analytic_gradient(full_gradient):
+    '''Decorator registering a closed-form gradient for U, so no differentiation is needed
+    
+    full_gradient takes the same arguments as U and returns the gradients 
+    wrt. each positional argument, as an (n_args, dim) array (or a list of 
+    n_args vectors). For example,
+    
+    def spring_gradient(q, p, *, k=1):
+        return [k * (q - p), k * (p - q)]
+    
+    @add_analytic_gradient(spring_gradient)
+    def spring(q, p, *, k=1):
+        return k / 2 * np.dot(q - p, q - p)
+    '''
+    def decorator(U):
+        U.full_gradient = full_gradient
+        return U
+    return decorator
+
+
 def add_gradients(U):
     """ after calling U = add_gradients(U), you'll be able to use U.gradient[i](q1,q2,...)
     
@@ -10,6 +10,8 @@ The dynamical system holds the information about the system that does
 not depend on time. 
 """
 import math
+import collections
+import numpy as np
 from tqdm import tqdm
 
 from matplotlib.path import Path
@@ -17,11 +19,14 @@ from matplotlib.path import Path
 
 import lagrangian.potentials
 
-from lagrangian.state import State, Coordinates, TrajectoryData
+from lagrangian.state import State, Coordinates, TrajectoryData, ArrayTrajectoryData, MemmapTrajectoryData, trajectory_storage_dict
 import lagrangian.collisions as collisions
 import lagrangian.integrators as integrators
 from lagrangian.renderer import MatPlotRenderer
 import lagrangian.celllists as celllists
+import lagrangian.parallel as parallel
+import lagrangian.phasespace as phasespace
+import lagrangian.kernels as kernels
 
 integrator_dict = integrators.integrator_dict 
 
@@ -37,8 +42,19 @@ class DynamicalSystem:
                  ylim = (-10, 10),
                  cell_list_dx = 1,
                  cell_list_dy = 1,
+                 verlet_list_cutoff = None,
+                 verlet_list_skin = None,
+                 cell_list_workers = 1,
                  wall_elasticity = 1,
-                 integrator_code = 'ssprk3'):
+                 boundary = 'walls',
+                 integrator_code = 'ssprk3',
+                 trajectory_storage = 'array',
+                 trajectory_path = 'trajectory',
+                 record_every = 1,
+                 record_dt = None,
+                 tolerance = 1e-6,
+                 respa_steps = 4,
+                 newton_iterations = 20):
         
         
         
@@ -50,9 +66,36 @@ class DynamicalSystem:
         self.ylim = ylim
         self.wall_elasticity = wall_elasticity
         
+        try:
+            self.boundary = collisions.boundary_dict[boundary]
+        except(KeyError):
+                raise KeyError(boundary, 
+                               ' not found. The valid boundary keys are ',
+                               collisions.boundary_dict.keys())
+        self.periodic = boundary == 'periodic'
+        self.periodic_box = collisions.box_lengths(xlim, ylim) if self.periodic else None
+        '''With boundary = 'periodic', xlim x ylim is a periodic box: particles 
+        are wrapped back into it every step and the cell-list pair potentials see 
+        the nearest periodic image of each neighbor. Ordinary potentials see the 
+        wrapped coordinates as they are.'''
+        
         self.cell_list_dx = cell_list_dx
         self.cell_list_dy = cell_list_dy
         
+        self.verlet_list_cutoff = verlet_list_cutoff
+        self.verlet_list_skin = verlet_list_skin
+        '''with a cutoff, the cell-list potentials use Verlet lists (see 
+        celllists.VerletLists) instead of rebuilding the cell lists every few steps.
+        The skin defaults to a third of the cutoff'''
+        
+        self.cell_list_workers = cell_list_workers
+        self.parallel_forces = None
+        '''with more than 1 worker, the cell-list forces are computed by that many
+        processes, each for a slab of the cells, see parallel.ParallelCellListForces'''
+        
+        self.trajectory_path = trajectory_path
+        '''directory the 'memmap' trajectory storage writes into'''
+        
         
         
         '''setup class variables in state and coordinate modules'''
@@ -80,7 +123,8 @@ class DynamicalSystem:
         
         
         
-        Coordinates.coordinates = self.coordinates
+        Coordinates.set_coordinates(self.coordinates)
+        self.mass_array = np.array([self.masses[i] for i in self.coordinates], dtype = float)
         State.dynamical_system = self
         
         
@@ -88,10 +132,45 @@ class DynamicalSystem:
         
         ''''set up instance variables for this dynamical system'''
         self.potentials = dict()
+        self.potential_sets = []
+        self.potential_set_dict = dict()
+        '''the potentials are also merged into potential sets, one for each 
+        function and kwargs, which is how the forces evaluate them, see 
+        potentials.PotentialSet. potential_set_dict finds the sets by 
+        PotentialSet.key'''
         self.cell_list_potentials = dict()
+        self.inverse_distance_potentials = dict()
         self.constraints = dict()
         self.dt = dt
         
+        self.N_force_evaluations = 0
+        self.N_steps_taken = 0
+        self.N_rejected_steps = 0
+        '''counted over a run of the dynamics, see force_evaluations_per_step'''
+        
+        self.tolerance = tolerance
+        '''for adaptive integrators ('dormand-prince'), the error allowed per 
+        step, relative to 1 + |q| and 1 + |q_dot|. dt is then only the first 
+        step size tried, while the states are still recorded record_dt apart.
+        Implicit integrators solve their equations to within tolerance, 
+        relative to 1 + |q|'''
+        
+        self.respa_steps = respa_steps
+        '''the 'respa' integrator takes respa_steps inner steps of the fast 
+        potentials for each dt step of the slow ones'''
+        
+        self.newton_iterations = newton_iterations
+        '''the most Newton iterations an implicit integrator ('implicit midpoint') 
+        takes a step, to bring the residual within tolerance'''
+        
+        if record_dt is not None:
+            record_every = max(1, round(record_dt / dt))
+        self.record_every = record_every
+        self.record_dt = dt * record_every
+        '''run_dynamics only stores every record_every-th state, record_dt apart. 
+        Pass record_dt to have record_every worked out from it'''
+        
+        self.integrator_code = integrator_code
         try:
             self.integrator = integrator_dict[integrator_code]
         except(KeyError):
@@ -99,24 +178,118 @@ class DynamicalSystem:
                                ' not found. The valid integrator keys are ',
                                integrator_dict.keys())
         
+        try:
+            self.trajectory_storage = trajectory_storage_dict[trajectory_storage]
+        except(KeyError):
+                raise KeyError(trajectory_storage, 
+                               ' not found. The valid trajectory storage keys are ',
+                               trajectory_storage_dict.keys())
+        
         
         
         
         
-    def add_potential(self, potential_function, args_list, **kwargs):
-        potential = lagrangian.potentials.Potential(potential_function, args_list, **kwargs)
+    def add_potential(self, potential_function, args_list, gradient = None, vectorized = False, group = 'fast', **kwargs):
+        '''gradient optionally gives the analytic gradient of potential_function, 
+        see derivatives.add_analytic_gradient. group is 'fast' or 'slow', see 
+        lagrangian.potentials.potential_groups. Vectorized potentials do all the
+        replicas of run_ensemble in one call, see potentials.Potential. 
+        
+        Potentials of the same function and kwargs are evaluated together, 
+        see potentials.PotentialSet'''
+        potential = lagrangian.potentials.Potential(potential_function, args_list, gradient, vectorized, **kwargs)
+        self.set_group(potential, group)
         potential_index = len(self.potentials)
         self.potentials[potential_index] = potential
+        
+        for potential_set in self.potential_set_dict.get(lagrangian.potentials.PotentialSet.key(potential), []):
+            if potential_set.matches(potential):
+                potential_set.add(potential)
+                return
+        potential_set = lagrangian.potentials.PotentialSet(potential)
+        self.potential_set_dict.setdefault(potential_set.key(potential), []).append(potential_set)
+        self.potential_sets.append(potential_set)
     
     
-    def add_cell_list_pair_potential(self, potential_function, **kwargs):
-        potential = lagrangian.potentials.CellListsPairPotential(potential_function, **kwargs)
+    def add_cell_list_pair_potential(self, potential_function, gradient = None, vectorized = False, group = 'fast', **kwargs):
+        '''vectorized potentials take the (M, 2) array of pair displacements, 
+        see potentials.CellListsPairPotential'''
+        potential = lagrangian.potentials.CellListsPairPotential(potential_function, 
+                                                                 gradient, 
+                                                                 vectorized, 
+                                                                 **kwargs)
+        self.set_group(potential, group)
         potential_index = len(self.cell_list_potentials)
         self.cell_list_potentials[potential_index] = potential
         
     
-    def add_constraint(self, constraint_function, args_list, **kwargs):
-        constraint = lagrangian.potentials.Constraint(constraint_function, args_list, **kwargs)
+    def add_inverse_distance_potential(self, 
+                                       coefficient, 
+                                       charges = None, 
+                                       solver = 'barnes-hut', 
+                                       opening_angle = 0.5,
+                                       softening = 0,
+                                       group = 'fast'):
+        '''Adds the long range potential coefficient * charges[i] * charges[j] / |q_i - q_j| of every pair i, j.
+        
+        charges is a dict indexed by coordinate, and defaults to the masses, so
+        gravity is add_inverse_distance_potential(-G). Rather than N^2 calls
+        to add_potential, the forces come from a Barnes-Hut quadtree, 
+        see potentials.InverseDistancePotential for the solver, 
+        opening_angle and softening. The Barnes-Hut tree lumps the charges 
+        of a node together, so they must all have the same sign.'''
+        if self.periodic:
+            raise ValueError('inverse distance potentials have no periodic images, use boundary = \'walls\'')
+        
+        charges = charges or self.masses
+        charge_array = np.array([charges[i] for i in self.coordinates])
+        if solver == 'barnes-hut' and charge_array.min() < 0 < charge_array.max():
+            raise ValueError('the barnes-hut solver needs charges of one sign, use solver = \'direct\' '
+                             'or add_particle_mesh_potential for mixed charges')
+        potential = lagrangian.potentials.InverseDistancePotential(coefficient, 
+                                                                   charge_array,
+                                                                   solver,
+                                                                   opening_angle,
+                                                                   softening)
+        self.set_group(potential, group)
+        potential_index = len(self.inverse_distance_potentials)
+        self.inverse_distance_potentials[potential_index] = potential
+        
+    
+    def add_particle_mesh_potential(self, 
+                                    coefficient, 
+                                    charges = None, 
+                                    N_grid = 64,
+                                    softening = None,
+                                    group = 'fast'):
+        '''The potential of add_inverse_distance_potential, with the forces from 
+        a particle mesh of N_grid x N_grid points over xlim x ylim. 
+        
+        O(N + N_grid^2 log N_grid) per step, for very many particles in smooth
+        fields, see particlemesh. Periodic boxes are fine here.'''
+        charges = charges or self.masses
+        potential = lagrangian.potentials.ParticleMeshPotential(coefficient, 
+                                                                [charges[i] for i in self.coordinates],
+                                                                self.xlim,
+                                                                self.ylim,
+                                                                N_grid,
+                                                                self.periodic,
+                                                                softening)
+        self.set_group(potential, group)
+        potential_index = len(self.inverse_distance_potentials)
+        self.inverse_distance_potentials[potential_index] = potential
+        
+    
+    def set_group(self, potential, group):
+        if group not in lagrangian.potentials.potential_groups:
+            raise ValueError(group, 
+                             ' is not a potential group. The valid groups are ',
+                             lagrangian.potentials.potential_groups)
+        potential.group = group
+        
+    
+    def add_constraint(self, constraint_function, args_list, gradient = None, **kwargs):
+        constraint = lagrangian.potentials.Constraint(constraint_function, args_list, gradient, **kwargs)
         constraint_index = len(self.constraints)
         self.constraints[constraint_index] = constraint
     
@@ -140,72 +313,220 @@ class DynamicalSystem:
         self.rendered_path_codes.append(Path.CLOSEPOLY)
     
         
-    def run_dynamics(self, total_time):
-        '''Iterate the system forward in time N_steps time steps and store in a TrajectoryData object
+    def new_neighbor_lists(self, N_replicas = None):
+        '''The cell lists (or Verlet lists) providing the pairs for the cell-list potentials.
+        
+        After a run, self.neighbor_lists.N_rebuilds and 
+        self.neighbor_lists.average_N_pairs tell how often the pairs were 
+        rebuilt and how many there were. For an ensemble of N_replicas 
+        replicas, each has its own.'''
+        if N_replicas is not None:
+            return celllists.EnsembleNeighborLists([self.new_neighbor_lists() for _ in range(N_replicas)])
+        
+        if self.verlet_list_cutoff is None:
+            return celllists.CellLists(self.xlim, 
+                                       self.cell_list_dx,
+                                       self.ylim,
+                                       self.cell_list_dy,
+                                       self.periodic)
+        
+        skin = self.verlet_list_skin or self.verlet_list_cutoff / 3
+        return celllists.VerletLists(self.xlim, 
+                                     self.ylim, 
+                                     self.verlet_list_cutoff, 
+                                     skin,
+                                     self.periodic)
+    
+    
+    def iter_dynamics(self, total_time = None, record_every = None, initial_state = None):
+        '''Iterate the system forward in time, yielding every record_every-th state as it is computed
+        
+        record_every defaults to the one the dynamical system was set up with,
+        and initial_state to self.initial_state.
+        With total_time = None the generator never stops. Only the last few 
+        states (as many as the integrator looks back at, see its history 
+        attribute) are kept, in self.recent_states, so the memory used doesn't 
+        grow with the length of the run.
         '''
+        dt = self.dt
+        N_steps = math.inf if total_time is None else math.ceil(total_time / dt)
+        record_every = record_every or self.record_every
+        
+        initial_state = self.initial_state if initial_state is None else initial_state
+        self.recent_states = collections.deque([initial_state], 
+                                               maxlen = getattr(self.integrator, 'history', 1))
+        self.N_force_evaluations = 0
+        self.N_steps_taken = 0
+        self.N_rejected_steps = 0
+        
         if self.cell_list_potentials:
-            self.run_cell_list_dynamics(total_time)
-        else:
+            N_replicas = len(initial_state.qs.array) if initial_state.qs.array.ndim == 3 else None
+            self.neighbor_lists = self.new_neighbor_lists(N_replicas)
+        
+            if self.cell_list_workers > 1 and N_replicas is None:
+                self.parallel_forces = parallel.ParallelCellListForces(self, self.cell_list_workers)
+        
+        try:
+            if getattr(self.integrator, 'adaptive', False):
+                yield from self.iter_adaptive_dynamics(N_steps // record_every, dt * record_every)
+            else:
+                yield from self.iter_steps(N_steps, record_every)
+        finally:
+            if self.parallel_forces is not None:
+                self.parallel_forces.close()
+                self.parallel_forces = None
+    
+    
+    def iter_steps(self, N_steps, record_every):
+        '''iter_dynamics for the integrators with a fixed dt'''
+        dt = self.dt
+        step = 0
+        while step < N_steps:
+            if self.cell_list_potentials:
+                self.forward_neighbor_pairs = \
+                    self.neighbor_lists.update(self.recent_states[-1])
             
-            dt = self.dt
-            N_steps = math.ceil(total_time / dt )
+            if step == 0 and len(self.recent_states) < self.recent_states.maxlen:
+                '''there is no previous state to look back at on the first step'''
+                next_state = integrators.midpoint_rule_next(self.recent_states[-1], dt)
+            else:
+                next_state = self.integrator(self.recent_states[-1], dt)
             
-        
-            self.trajectory_data = TrajectoryData(self)
-            t=0 + dt
-            second_state = integrators.midpoint_rule_next(self.trajectory_data[0], dt)
-            self.trajectory_data.append(second_state)
-            t += dt
+            next_state = self.boundary(next_state,
+                                       xlim = self.xlim,
+                                       ylim = self.ylim,
+                                       wall_elasticity = self.wall_elasticity)
+            self.recent_states.append(next_state)
+            step += 1
+            self.N_steps_taken = step
+            
+            if step % record_every == 0:
+                yield next_state
+    
+    
+    def iter_adaptive_dynamics(self, N_records, record_dt):
+        '''iter_dynamics for adaptive integrators: yields the states at times record_dt, 2*record_dt, ... 
+        
+        The steps are as large as self.tolerance allows, and the recorded 
+        states between them come from integrators.hermite_interpolation.'''
+        tableau = self.integrator.tableau
+        state = self.recent_states[-1]
+        t, dt = 0, self.dt
+        record = 1
+        
+        while record <= N_records:
+            if self.cell_list_potentials:
+                self.forward_neighbor_pairs = self.neighbor_lists.update(state)
             
-            for i in tqdm(range(1, N_steps-1)):  #add tqdm loop counter display
-                next_state = self.integrator(self.trajectory_data[-1], dt)
-                
-                next_state = collisions.resolve_wall_collisions(next_state,
-                                                           xlim = self.xlim,
-                                                           ylim = self.ylim,
-                                                           wall_elasticity = self.wall_elasticity)
-                self.trajectory_data.append(next_state)
-                
-                t += dt
-                
-        print("dynamics finished!\r")
+            next_state, k, dt_taken, dt = integrators.adaptive_rk_step(state, tableau, dt, self.tolerance,
+                                                                       min_dt = 1e-12 * self.dt)
             
-        #self.trajectory_data = trajectories
+            while record <= N_records and record * record_dt <= t + dt_taken:
+                theta = (record * record_dt - t) / dt_taken
+                yield self.boundary(integrators.hermite_interpolation(state, next_state, k, dt_taken, theta),
+                                    xlim = self.xlim,
+                                    ylim = self.ylim,
+                                    wall_elasticity = self.wall_elasticity)
+                record += 1
+            
+            t += dt_taken
+            state = self.boundary(next_state,
+                                  xlim = self.xlim,
+                                  ylim = self.ylim,
+                                  wall_elasticity = self.wall_elasticity)
+            self.recent_states.append(state)
+            self.N_steps_taken += 1
     
-    def run_cell_list_dynamics(self, total_time):
-        dt = self.dt
-        N_steps = math.ceil(total_time / dt )
-        
     
-        self.trajectory_data = TrajectoryData(self)
-        t=0 + dt
-        
-        cell_lists = celllists.CellLists(self.xlim, 
-                                         self.cell_list_dx,
-                                         self.ylim,
-                                         self.cell_list_dy)
-        self.forward_neighbor_lists = \
-            cell_lists.generate_forward_neighbor_lists(self.trajectory_data[-1])
+    def run_dynamics(self, total_time, progress = True):
+        '''Iterate the system forward in time total_time and store the states in a TrajectoryData object
         
+        progress = False runs quietly, without the progress bar and messages 
+        (for batch jobs, see sweep).'''
+        N_records = math.ceil(total_time / self.dt) // self.record_every
         
-        second_state = integrators.midpoint_rule_next(self.trajectory_data[0], dt)
-        self.trajectory_data.append(second_state)
-        t += dt
+        self.trajectory_data = self.trajectory_storage(self, N_records + 1)
         
-        for i in tqdm(range(2, N_steps-1)):  #add tqdm loop counter display
-            if i % 5 == 0:
-                self.forward_neighbor_lists = \
-                    cell_lists.generate_forward_neighbor_lists(self.trajectory_data[-1])
-            next_state = self.integrator(self.trajectory_data[-1], dt)
-            #print(next_state.qs)
-            
-            next_state = collisions.resolve_wall_collisions(next_state,
-                                                       xlim = self.xlim,
-                                                       ylim = self.ylim,
-                                                       wall_elasticity = self.wall_elasticity)
+        for next_state in tqdm(self.iter_dynamics(total_time), total = N_records, disable = not progress):  #add tqdm loop counter display
             self.trajectory_data.append(next_state)
-            
-            t += dt
+        
+        self.trajectory_data.flush()
+        
+        if progress:
+            print("dynamics finished!\r")
+    
+    
+    @property
+    def force_evaluations_per_step(self):
+        '''the average number of times State.get_forces was called per step of the last run
+        
+        For integrators looking back at previous states (verlet) the first step 
+        is a midpoint rule step, with 2. For adaptive 
+        integrators this counts the accepted steps only, and the rejected ones
+        are in N_rejected_steps.'''
+        return self.N_force_evaluations / max(self.N_steps_taken, 1)
+    
+    
+    def compile(self, integrator_code = None, jit = False):
+        '''The phase space of the system, its forces and integrator on flat arrays, see phasespace.PhaseSpace
+        
+        compile().run_dynamics(total_time) runs the dynamics of run_dynamics 
+        without making a State every stage. Potentials added afterwards aren't 
+        in it. With jit = True, a system made of kernels (see lagrangian.kernels)
+        runs in Numba instead, when it is installed.'''
+        if jit and kernels.jit_supported(self, integrator_code):
+            return kernels.KernelPhaseSpace(self, integrator_code)
+        return phasespace.PhaseSpace(self, integrator_code)
+    
+    
+    def run_ensemble(self, total_time, qs_inits_raw, q_dots_inits_raw = None, progress = True):
+        '''Runs M replicas of the system from M initial conditions at once, returning the M ArrayTrajectoryData
+        
+        qs_inits_raw (and q_dots_inits_raw) are lists of M dicts like 
+        qs_init_raw. The replicas are stacked into states whose qs are 
+        (M, N, dim) arrays, so each force evaluation and integrator stage is 
+        done for all of them together (see State.get_ensemble_forces), which is
+        much faster than M runs when the potentials are vectorized. Adaptive 
+        integrators take the same steps for all the replicas. The trajectories
+        are also kept in self.ensemble_trajectory_data. progress shows a 
+        progress bar, as in run_dynamics.
+        '''
+        if self.constraints:
+            raise ValueError('constraints are not supported in ensembles')
+        if not getattr(self.integrator, 'ensembles', True):
+            raise ValueError(self.integrator.__name__, ' does not support ensembles')
+        
+        q_dots_inits_raw = q_dots_inits_raw or [None] * len(qs_inits_raw)
+        replicas = [State(qs_init_raw, q_dots_init_raw) 
+                    for qs_init_raw, q_dots_init_raw in zip(qs_inits_raw, q_dots_inits_raw)]
+        initial_state = State.from_arrays(np.stack([replica.qs.array for replica in replicas]),
+                                          np.stack([replica.q_dots.array for replica in replicas]))
+        
+        N_records = math.ceil(total_time / self.dt) // self.record_every
+        self.ensemble_trajectory_data = [ArrayTrajectoryData(self, N_records + 1, replica) 
+                                         for replica in replicas]
+        
+        for next_state in tqdm(self.iter_dynamics(total_time, initial_state = initial_state), 
+                               total = N_records, disable = not progress):
+            for m, trajectory_data in enumerate(self.ensemble_trajectory_data):
+                trajectory_data.append(State.from_arrays(next_state.qs.array[m], next_state.q_dots.array[m]))
+        
+        if progress:
+            print("ensemble dynamics finished!\r")
+        return self.ensemble_trajectory_data
+    
+    
+    def run_cell_list_dynamics(self, total_time):
+        '''run_dynamics takes care of the cell lists now, this is kept for old scripts'''
+        self.run_dynamics(total_time)
+    
+    
+    def load_trajectory(self, path = None):
+        '''reads back a trajectory stored by an earlier run with trajectory_storage = 'memmap'
+        
+        Afterwards display() renders it without having to run the dynamics again.'''
+        self.trajectory_data = MemmapTrajectoryData.open(self, path)
+    
     
     def display(self):
         trajectories = self.trajectory_data
@@ -7,9 +7,11 @@ Created on Thu Dec 24 23:49:32 2020
 """
 
 
+import math
 import numpy as np
 
 from lagrangian.state import State, Coordinates
+import lagrangian.collisions as collisions
 
 
 def verlet_next(state, dt = None):
@@ -17,17 +19,25 @@ def verlet_next(state, dt = None):
         dt = state.dynamical_system.dt
         
     current_state = state.qs
-    previous_state = state.dynamical_system.trajectory_data[-2]
+    previous_state = state.dynamical_system.recent_states[-2]
     
     q_dotdots = state.get_acceleration()
     
-    qs_next = 2 * state.qs - previous_state.qs + dt**2  * q_dotdots 
+    qs_step = state.qs - previous_state.qs
+    if state.dynamical_system.periodic_box is not None:
+        '''the particle may have been wrapped around the box since the previous state'''
+        qs_step.array = collisions.minimum_image(qs_step.array, state.dynamical_system.periodic_box)
+    
+    qs_next = state.qs + qs_step + dt**2  * q_dotdots 
     
     q_dots_next = state.q_dots #(we aren't updating these because they are not needed. If they are needed, use velocity verlet
     
     state_next = State(qs_next, q_dots_next)
     return state_next
 
+verlet_next.history = 2
+'''number of recent states the dynamical system must keep around for verlet_next'''
+
     
 def deprecated_verlet_next(state, phase_space, dt=None):
     '''We're going to assume q_n, and q_dots_n are related as follows
@@ -61,6 +71,231 @@ def deprecated_verlet_next(state, phase_space, dt=None):
     return state_next
 
 
+class SymplecticComposition:
+    '''A symplectic scheme made of drifts and kicks
+    
+    A step of size dt is, for each l in turn,
+        
+        qs += drifts[l] * dt * q_dots                   (drift)
+        q_dots += kicks[l] * dt * q_dotdots(qs)         (kick)
+        
+    skipping the zero ones. A kick right after a kick (or at the start of the
+    step) reuses the accelerations it already has, and the ones at the end of
+    a step are left on the next state as q_dotdots for the next step to start
+    with, so a step costs as many force evaluations as it has drifts 
+    followed by a kick.
+    '''
+    
+    def __init__(self, drifts, kicks):
+        self.drifts = drifts
+        self.kicks = kicks
+        
+        
+def symplectic_next(state, composition, dt = None):
+    if dt is None:
+        dt = state.dynamical_system.dt
+    
+    qs, q_dots = state.qs.array, state.q_dots.array
+    q_dotdots = getattr(state, 'q_dotdots', None)
+    
+    for drift, kick in zip(composition.drifts, composition.kicks):
+        if drift != 0:
+            qs = qs + (drift * dt) * q_dots
+            q_dotdots = None
+        if kick != 0:
+            if q_dotdots is None:
+                q_dotdots = State.from_arrays(qs, q_dots).get_acceleration().array
+            q_dots = q_dots + (kick * dt) * q_dotdots
+    
+    state_next = State.from_arrays(qs, q_dots)
+    if q_dotdots is not None:
+        state_next.q_dotdots = q_dotdots
+    return state_next
+
+
+_w1 = 1 / (2 - 2**(1/3))
+_w0 = 1 - 2 * _w1
+'''the weights of the 4th order composition of three 2nd order steps, w1 + w0 + w1 = 1'''
+
+velocity_verlet = SymplecticComposition(drifts = [0, 1], 
+                                        kicks = [1/2, 1/2])
+'''kick, drift, kick: 2nd order, 1 force evaluation a step'''
+
+leapfrog = SymplecticComposition(drifts = [1/2, 1/2], 
+                                 kicks = [1, 0])
+'''drift, kick, drift: 2nd order, 1 force evaluation a step'''
+
+yoshida4 = SymplecticComposition(drifts = [0, _w1, _w0, _w1], 
+                                 kicks = [_w1/2, (_w1 + _w0)/2, (_w0 + _w1)/2, _w1/2])
+'''velocity verlet steps of w1*dt, w0*dt, w1*dt: 4th order, 3 force evaluations a step'''
+
+forest_ruth = SymplecticComposition(drifts = [_w1/2, (_w1 + _w0)/2, (_w0 + _w1)/2, _w1/2], 
+                                    kicks = [_w1, _w0, _w1, 0])
+'''leapfrog steps of w1*dt, w0*dt, w1*dt: 4th order, 3 force evaluations a step'''
+
+
+def velocity_verlet_next(state, dt = None):
+    return symplectic_next(state, velocity_verlet, dt)
+
+
+def leapfrog_next(state, dt = None):
+    return symplectic_next(state, leapfrog, dt)
+
+
+def yoshida4_next(state, dt = None):
+    return symplectic_next(state, yoshida4, dt)
+
+
+def forest_ruth_next(state, dt = None):
+    return symplectic_next(state, forest_ruth, dt)
+
+
+def bond_hessian(state):
+    '''The Hessian of the potentials (not the cell-list or long range ones) as a sparse matrix
+    
+    Each potential only couples its own coordinates, so the Hessian is 
+    assembled from the blocks potential.hessian, following the bonds. Returns 
+    (rows, columns, values) of the nonzero entries, with coordinate i, 
+    component a at index i * dim + a.'''
+    dim = Coordinates.dim
+    rows, columns, values = [], [], []
+    for potential in state.dynamical_system.potentials.values():
+        indices = (np.array(potential.rows)[:, np.newaxis] * dim + np.arange(dim)).ravel()
+        rows.append(np.repeat(indices, len(indices)))
+        columns.append(np.tile(indices, len(indices)))
+        values.append(potential.hessian(state.qs.array).ravel())
+    
+    if not rows:
+        return np.zeros(0, dtype = int), np.zeros(0, dtype = int), np.zeros(0)
+    return np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+
+def conjugate_gradient(matvec, b, diagonal, tolerance = 1e-10, max_iterations = 200):
+    '''Solves A x = b with conjugate gradients, for A given by x -> matvec(x) and
+    preconditioned with its diagonal
+    
+    A must be symmetric positive definite (SPD). If it turns out not to be
+    (p @ A p <= 0 for a search direction p, or a diagonal entry <= 0), A is
+    assembled column by column from matvec and solved with np.linalg.solve.'''
+    if not np.all(diagonal > 0):
+        return dense_solve(matvec, b)
+    
+    x = np.zeros_like(b)
+    r = b.copy()
+    z = r / diagonal
+    p = z.copy()
+    rz = r @ z
+    b_norm = np.linalg.norm(b)
+    
+    for _ in range(max_iterations):
+        if np.linalg.norm(r) <= tolerance * b_norm:
+            break
+        Ap = matvec(p)
+        pAp = p @ Ap
+        if not pAp > 0:
+            '''A isn't positive definite, as the implicit midpoint Jacobian 
+            can be with strongly compressed springs'''
+            return dense_solve(matvec, b)
+        alpha = rz / pAp
+        x += alpha * p
+        r -= alpha * Ap
+        z = r / diagonal
+        rz, rz_old = r @ z, rz
+        p = z + (rz / rz_old) * p
+    return x
+
+
+def dense_solve(matvec, b):
+    '''Solves A x = b for any invertible A given by x -> matvec(x), in O(len(b)^3)'''
+    A = np.column_stack([matvec(e) for e in np.eye(len(b))])
+    return np.linalg.solve(A, b)
+
+
+def implicit_midpoint_next(state, dt = None):
+    '''The implicit midpoint rule, for stiff springs: symplectic, 2nd order and stable at any dt
+    
+    With q_m, q_dot_m the midpoint of the step,
+        q_1 = q_0 + dt * q_dot_m,    q_dot_1 = q_dot_0 + dt * q_dotdot(q_m)
+    which comes down to solving
+        M (q_m - q_0 - dt/2 * q_dot_0) - dt**2/4 * forces(q_m) = 0
+    for q_m with Newton's method. The Jacobian M + dt**2/4 * H, H the Hessian
+    of the potentials, is sparse: it is assembled from the bonds with 
+    bond_hessian once a step, and solved with conjugate_gradient. Cell-list 
+    and long range potentials are left out of the Jacobian (they are in the
+    forces), which only slows down the Newton iterations a little as long as
+    they are softer than the springs.
+    '''
+    dynamical_system = state.dynamical_system
+    if dt is None:
+        dt = dynamical_system.dt
+    
+    shape = state.qs.array.shape
+    masses = np.repeat(dynamical_system.mass_array, shape[1])
+    qs, q_dots = state.qs.array, state.q_dots.array
+    q_m = qs + dt / 2 * q_dots
+    
+    rows, columns, values = bond_hessian(State.from_arrays(q_m, q_dots))
+    values = dt**2 / 4 * values
+    diagonal = masses + np.bincount(rows[rows == columns], values[rows == columns], minlength = len(masses))
+    def jacobian(x):
+        return masses * x + np.bincount(rows, values * x[columns], minlength = len(x))
+    
+    for _ in range(dynamical_system.newton_iterations):
+        forces = State.from_arrays(q_m, q_dots).get_forces().array
+        residual = (masses * (q_m - qs - dt / 2 * q_dots).ravel() - dt**2 / 4 * forces.ravel())
+        if np.abs(residual / masses).max() <= dynamical_system.tolerance * (1 + np.abs(q_m).max()):
+            break
+        q_m = q_m - conjugate_gradient(jacobian, residual, diagonal).reshape(shape)
+    else:
+        raise RuntimeError('the Newton iterations of implicit_midpoint_next did not converge, try a smaller dt')
+    
+    q_dotdots = forces / dynamical_system.mass_array[:, np.newaxis]
+    return State.from_arrays(2 * q_m - qs, q_dots + dt * q_dotdots)
+
+
+implicit_midpoint_next.ensembles = False
+'''bond_hessian assembles the Jacobian of a single system'''
+
+
+def respa_next(state, dt = None):
+    '''Multiple time step (r-RESPA) velocity verlet: the slow potentials kick at dt, the fast ones at dt / respa_steps
+    
+    Each step is a half kick of the slow forces, respa_steps velocity verlet 
+    steps of size dt / respa_steps with the fast forces only, and another half
+    kick of the slow forces. Put the expensive smooth potentials in the slow
+    group and the stiff cheap ones (springs) in the fast one, see 
+    potentials.potential_groups. The accelerations at the end of a step are 
+    left on the next state as respa_accelerations and reused, so a step costs
+    respa_steps fast force evaluations and 1 slow one.
+    '''
+    dynamical_system = state.dynamical_system
+    if dt is None:
+        dt = dynamical_system.dt
+    inner_dt = dt / dynamical_system.respa_steps
+    
+    accelerations = getattr(state, 'respa_accelerations', None)
+    if accelerations is None:
+        accelerations = (state.get_acceleration(['fast']).array, 
+                         state.get_acceleration(['slow']).array)
+    fast_q_dotdots, slow_q_dotdots = accelerations
+    
+    qs = state.qs.array
+    q_dots = state.q_dots.array + dt / 2 * slow_q_dotdots
+    
+    for _ in range(dynamical_system.respa_steps):
+        q_dots = q_dots + inner_dt / 2 * fast_q_dotdots
+        qs = qs + inner_dt * q_dots
+        fast_q_dotdots = State.from_arrays(qs, q_dots).get_acceleration(['fast']).array
+        q_dots = q_dots + inner_dt / 2 * fast_q_dotdots
+    
+    slow_q_dotdots = State.from_arrays(qs, q_dots).get_acceleration(['slow']).array
+    q_dots = q_dots + dt / 2 * slow_q_dotdots
+    
+    state_next = State.from_arrays(qs, q_dots)
+    state_next.respa_accelerations = (fast_q_dotdots, slow_q_dotdots)
+    return state_next
+
+
 def forward_euler_next(state, dt = None):
     if dt is None:
         dt = state.dynamical_system.dt
@@ -120,7 +355,7 @@ def rk_slope(state):
     f_q = state.q_dots
     f_q_dots = state.get_acceleration()
     
-    return State(f_q, f_q_dots)
+    return State.from_arrays(f_q.array, f_q_dots.array)
 
 
 def rk_sampler(state, k_i, dt = None):
@@ -150,89 +385,231 @@ def rk_sampler(state, k_i, dt = None):
     return rk_slope(sample_state)
     
 
-def rk_ks(state, a, dt):
-    '''returns the ks for the rk-scheme with matrix a_ij
+class ButcherTableau:
+    '''The Butcher tableau of an explicit s-stage Runge Kutta scheme
+    
+        k_l = f(y_n + dt * (a[l,0]*k_0 + ... + a[l,l-1]*k_l-1))      l = 0, ..., s-1
+        y_n+1 = y_n + dt * (b[0]*k_0 + ... + b[s-1]*k_s-1)
+    
+    a is the s x s strictly lower triangular matrix and b has length s, so a 
+    step evaluates the forces exactly s times. If the scheme is first same as
+    last (fsal), the last stage is sampled at y_n+1 itself, its slope is the 
+    k_0 of the next step, and a step only costs s - 1 force evaluations.
+    
+    b_error, if given, holds the weights of an embedded lower order solution, 
+    for error estimates.
+    '''
+    
+    def __init__(self, a, b, fsal = False, b_error = None):
+        self.a = np.array(a, dtype = float)
+        self.b = np.array(b, dtype = float)
+        self.c = self.a.sum(axis = 1)
+        self.s = len(self.b)
+        self.fsal = fsal
+        self.b_error = None if b_error is None else np.array(b_error, dtype = float)
+        
+        if self.a.shape != (self.s, self.s) or np.any(np.triu(self.a) != 0):
+            raise ValueError('a must be a strictly lower triangular ', (self.s, self.s), 
+                             ' matrix for an explicit scheme')
+        if fsal and not (np.allclose(self.a[-1], self.b) and self.b[-1] == 0):
+            raise ValueError('a first same as last scheme samples its last stage at y_n+1')
+        
+        
+    @property
+    def force_evaluations_per_step(self):
+        return self.s - 1 if self.fsal else self.s
+
+
+def rk_ks(state, tableau, dt):
+    '''returns the s ks of the rk-scheme with the Butcher tableau, as (qs, q_dots) array pairs
     
     The formula for the ks is
         k_l = f(y_n + dt * (a[l,0]*k_0 + a[l,1]*k_1 + dots + a[l,l-1] * k_l-1))
-    an s-step scheme runs l from 0 all the way up to l=s-1. For such a scheme, a_ij
-    will be an s-1 x s-1 matrix (indexed from 0 to s-2)
+    with l running from 0 to s-1. k_0 = f(y_n) is taken from state.fsal_slope
+    when the last step left it there.
     '''
-    s = len(a)
+    a = tableau.a
+    qs, q_dots = state.qs.array, state.q_dots.array
     k = [] #the k indexing starts at 0 instead of 1
     
-    k0 = rk_slope(state)
-    k.append(k0)
-    #stops at s-1 as expected
-    for l in range(s): 
-        #stops at s-1 as expected
+    for l in range(tableau.s):
+        if l == 0 and tableau.fsal and getattr(state, 'fsal_slope', None) is not None:
+            k.append(state.fsal_slope)
+            continue
         
-            
-        sample_state_l_qs = state.qs + \
-             dt * sum([a[l,m] * (k[m].qs) for m in range(l)], start=Coordinates()) 
-             #sum with a start gives a 0 object to start adding to. This is especially
-             #important when it comes to empty lists
-
-        
-        sample_state_l_q_dots = state.q_dots + \
-            dt * sum([a[l,m] * k[m].q_dots for m in range(l)], start=Coordinates())
-             
-        sample_state = State(sample_state_l_qs, sample_state_l_q_dots)
+        sample_qs, sample_q_dots = qs, q_dots
+        for m in range(l):
+            if a[l, m] != 0:
+                sample_qs = sample_qs + (dt * a[l, m]) * k[m][0]
+                sample_q_dots = sample_q_dots + (dt * a[l, m]) * k[m][1]
         
+        sample_state = State.from_arrays(sample_qs, sample_q_dots)
         k_l = rk_slope(sample_state)
-        k.append(k_l)
+        k.append((k_l.qs.array, k_l.q_dots.array))
     
     return k
 
 
+def rk_combination(k, weights, dt):
+    '''dt * (weights[0]*k_0 + ... + weights[s-1]*k_s-1), as a (qs, q_dots) array pair'''
+    return tuple(dt * sum(w_l * k_l[part] for w_l, k_l in zip(weights, k) if w_l != 0)
+                 for part in range(2))
 
-    
 
-def rk_general_next(state, a, b, dt = None):
+def rk_next(state, tableau, dt = None):
     if dt == None:
         dt = state.dynamical_system.dt
     
-    s = len(b)
-    
-    k = rk_ks(state, a, dt)
-    
-    next_state_qs = state.qs + dt * sum([b[i]*k[i].qs for i in range(s)], start=Coordinates())
-    next_state_q_dots = state.q_dots + dt * sum([b[i]*k[i].q_dots for i in range(s)], start=Coordinates())
+    k = rk_ks(state, tableau, dt)
     
-    next_state = State(next_state_qs, next_state_q_dots)
+    step_qs, step_q_dots = rk_combination(k, tableau.b, dt)
+    next_state = State.from_arrays(state.qs.array + step_qs, state.q_dots.array + step_q_dots)
+    if tableau.fsal:
+        next_state.fsal_slope = k[-1]
     
     return next_state
 
 
-def ssprk3_next(state, dt = None):
-    if dt == None:
-        dt = state.dynamical_system.dt
+max_rejections = 50
+'''the number of times adaptive_rk_step may shrink dt before it gives up on a step'''
+
+
+def adaptive_rk_step(state, tableau, dt, tolerance, min_dt = None):
+    '''Takes one step of the embedded scheme, shrinking dt until its error estimate is within tolerance
+    
+    The error estimate is the difference of the two solutions the tableau 
+    gives (with weights b and b_error), measured relative to 
+    tolerance * (1 + |y|) in each component and averaged (root mean square).
+    Returns the next state, the ks of the step, the dt taken, and the dt to 
+    try next, grown or shrunk by the usual (1 / error)^(1/5) rule.
+    
+    Raises a RuntimeError if the error estimate isn't finite (the forces blew
+    up), if dt falls below min_dt (1e-12 of the dt it was called with by 
+    default), or if the step is rejected max_rejections times.
+    '''
+    y = (state.qs.array, state.q_dots.array)
+    if min_dt is None:
+        min_dt = 1e-12 * dt
+    
+    for rejections in range(max_rejections + 1):
+        k = rk_ks(state, tableau, dt)
+        step = rk_combination(k, tableau.b, dt)
+        error = rk_combination(k, tableau.b - tableau.b_error, dt)
+        
+        next_y = (y[0] + step[0], y[1] + step[1])
+        error_norm = math.sqrt(np.mean([np.mean((e / (tolerance * (1 + np.maximum(abs(y_i), abs(next_y_i)))))**2) 
+                                        for e, y_i, next_y_i in zip(error, y, next_y)]))
+        
+        if not np.isfinite(error_norm):
+            raise RuntimeError('the error estimate of adaptive_rk_step is not finite at dt = ', dt,
+                               ', the forces may have blown up')
+        
+        factor = 5 if error_norm == 0 else min(5, max(0.2, 0.9 * error_norm**-0.2))
+        if error_norm <= 1:
+            break
+        
+        state.dynamical_system.N_rejected_steps += 1
+        dt *= factor
+        if dt < min_dt:
+            raise RuntimeError('adaptive_rk_step shrank dt below ', min_dt, 
+                               ' without meeting the tolerance, try a larger tolerance')
+    else:
+        raise RuntimeError('adaptive_rk_step rejected ', max_rejections, 
+                           ' steps in a row without meeting the tolerance, try a larger tolerance')
+    
+    next_state = State.from_arrays(*next_y)
+    if tableau.fsal:
+        next_state.fsal_slope = k[-1]
+    return next_state, k, dt, dt * factor
+
+
+def hermite_interpolation(state, next_state, k, dt, theta):
+    '''Dense output: the state a fraction theta of the way through a step of size dt
+    
+    This is the cubic through the two states with the slopes k[0] and k[-1] at
+    either end, which the ks of a first same as last scheme already have, so 
+    the frames cost no force evaluations.'''
+    h00 = 2*theta**3 - 3*theta**2 + 1
+    h10 = theta**3 - 2*theta**2 + theta
+    h01 = -2*theta**3 + 3*theta**2
+    h11 = theta**3 - theta**2
+    
+    y, next_y = (state.qs.array, state.q_dots.array), (next_state.qs.array, next_state.q_dots.array)
+    return State.from_arrays(*[h00 * y[part] + h10 * dt * k[0][part] + 
+                               h01 * next_y[part] + h11 * dt * k[-1][part] 
+                               for part in range(2)])
     
-    a = np.array([[0.0, 0.0, 0.0],
-                    [1.0, 0.0, 0.0],
-                    [0.25, 0.25, 0.0]
-                    ])
-    b = np.array([1/6, 1/6, 2/3], dtype=float)
 
-    next_state = rk_general_next(state, a, b, dt)
+def rk_general_next(state, a, b, dt = None):
+    '''rk_next with the tableau given by the matrix a and the weights b'''
+    return rk_next(state, ButcherTableau(a, b), dt)
+
+
+ssprk3_tableau = ButcherTableau(a = [[0.0, 0.0, 0.0],
+                                     [1.0, 0.0, 0.0],
+                                     [0.25, 0.25, 0.0]
+                                     ],
+                                b = [1/6, 1/6, 2/3])
+
+rk4_tableau = ButcherTableau(a = [[0.0, 0.0, 0.0, 0.0],
+                                  [0.5, 0.0, 0.0, 0.0],
+                                  [0.0, 0.5, 0.0, 0.0],
+                                  [0.0, 0.0, 1.0, 0.0]
+                                  ],
+                             b = [1/6, 1/3, 1/3, 1/6])
+
+bogacki_shampine_tableau = ButcherTableau(a = [[0.0, 0.0, 0.0, 0.0],
+                                               [1/2, 0.0, 0.0, 0.0],
+                                               [0.0, 3/4, 0.0, 0.0],
+                                               [2/9, 1/3, 4/9, 0.0]
+                                               ],
+                                          b = [2/9, 1/3, 4/9, 0.0],
+                                          fsal = True,
+                                          b_error = [7/24, 1/4, 1/3, 1/8])
+'''third order in 3 force evaluations a step, thanks to first same as last'''
 
-    return next_state
+
+def ssprk3_next(state, dt = None):
+    return rk_next(state, ssprk3_tableau, dt)
 
 
 def rk45_next(state, dt = None):
-    if dt == None:
-        dt = state.dynamical_system.dt
+    return rk_next(state, rk4_tableau, dt)
+
+
+def bogacki_shampine_next(state, dt = None):
+    return rk_next(state, bogacki_shampine_tableau, dt)
+
+
+dormand_prince_tableau = ButcherTableau(a = [[0, 0, 0, 0, 0, 0, 0],
+                                             [1/5, 0, 0, 0, 0, 0, 0],
+                                             [3/40, 9/40, 0, 0, 0, 0, 0],
+                                             [44/45, -56/15, 32/9, 0, 0, 0, 0],
+                                             [19372/6561, -25360/2187, 64448/6561, -212/729, 0, 0, 0],
+                                             [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656, 0, 0],
+                                             [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0]
+                                             ],
+                                        b = [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0],
+                                        fsal = True,
+                                        b_error = [5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40])
+'''fifth order with an embedded fourth order solution, in 6 force evaluations a step'''
+
+
+def dormand_prince_next(state, dt = None):
+    '''a fixed dt step of Dormand-Prince 5(4). 
     
-    a = np.array([[0.0, 0.0, 0.0, 0.0],
-                     [0.5, 0.0, 0.0, 0.0],
-                     [0.0, 0.5, 0.0, 0.0],
-                     [0.0, 0.0, 1.0, 0.0]
-                     ])
-    b = np.array([1/6, 1/3, 1/3, 1/6], dtype=float)
+    With this integrator the dynamical system adapts dt to its tolerance 
+    instead, see DynamicalSystem.iter_dynamics'''
+    return rk_next(state, dormand_prince_tableau, dt)
 
-    next_state = rk_general_next(state, a, b, dt)
 
-    return next_state
+ssprk3_next.tableau = ssprk3_tableau
+rk45_next.tableau = rk4_tableau
+bogacki_shampine_next.tableau = bogacki_shampine_tableau
+dormand_prince_next.tableau = dormand_prince_tableau
+
+dormand_prince_next.adaptive = True
+'''the dynamical system takes adaptive steps with adaptive_rk_step for this integrator'''
 
 
 
@@ -240,7 +617,15 @@ integrator_dict = {'forward euler':forward_euler_next,
                'midpoint rule': midpoint_rule_next,
                'rk45':rk45_next,
                'ssprk3':ssprk3_next,
+               'bogacki-shampine': bogacki_shampine_next,
+               'dormand-prince': dormand_prince_next,
                'verlet':verlet_next,
+               'velocity verlet': velocity_verlet_next,
+               'leapfrog': leapfrog_next,
+               'yoshida4': yoshida4_next,
+               'forest-ruth': forest_ruth_next,
+               'respa': respa_next,
+               'implicit midpoint': implicit_midpoint_next,
                'semi-implicit euler': semi_implicit_euler_next
                }
 
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kernels: potentials the library knows the form of, so it can compile them.
+
+spring, uniform_gravity and lennard_jones are ordinary potential functions
+with analytic gradients, and work in any dynamical system:
+
+dynamical_system.add_potential(kernels.spring, ['q1', 'q2'], spring_constant = 10, rest_length = 1)
+dynamical_system.add_potential(kernels.uniform_gravity, names, g = 9.8, masses = [masses[i] for i in names])
+dynamical_system.add_cell_list_pair_potential(kernels.lennard_jones, vectorized = True, sigma = 1, cutoff = 2.5)
+
+A system whose potentials are all kernels can also be compiled with Numba
+(if it is installed), dynamical_system.compile(jit = True). The forces, the
+integrator steps and the walls then all run in nopython mode, record_every
+steps per call, and Python only sees the recorded frames. Without Numba, or
+with any other potential, compile(jit = True) gives the array phase space of
+phasespace instead, which runs the same dynamics, only slower.
+
+The compiled Lennard-Jones forces bin the particles into cells at least
+cutoff wide every step, rather than using the cell lists of the dynamical
+system, so the cutoff has to be at most the reach of those cell lists for
+the two to agree.
+"""
+
+import inspect
+import math
+
+import numpy as np
+
+import lagrangian.derivatives as derivatives
+import lagrangian.integrators as integrators
+from lagrangian.phasespace import PhaseSpace
+
+numba = None
+'''the numba module, imported by _import_numba when a system is first compiled
+with jit = True (False if it isn't installed), so importing kernels doesn't
+import Numba'''
+
+
+def _import_numba():
+    '''Imports Numba the first time it is needed. Returns whether it is installed'''
+    global numba
+    if numba is None:
+        try:
+            import numba as numba_module
+        except ImportError:
+            numba_module = False
+        numba = numba_module
+    return numba is not False
+
+
+_jit_functions = ('_kernel_forces', '_boundary', '_rk_steps', '_symplectic_steps')
+'''the functions KernelPhaseSpace runs in nopython mode. They are defined as 
+plain Python, and _jit_kernels swaps them for their numba.njit versions'''
+
+_kernels_jitted = False
+
+
+def _jit_kernels():
+    '''Replaces the functions of _jit_functions by their numba.njit versions, once
+
+    njit only compiles a function on its first call, and looks up the functions
+    it calls then, so the compiled _rk_steps and _symplectic_steps call the 
+    compiled _kernel_forces and _boundary.'''
+    global _kernels_jitted
+    if not _kernels_jitted:
+        module = globals()
+        for name in _jit_functions:
+            module[name] = numba.njit(module[name])
+        _kernels_jitted = True
+
+
+def spring_gradient(q, p, *, spring_constant = 1, rest_length = 0):
+    r = q - p
+    if rest_length == 0:
+        gradient = spring_constant * r
+    else:
+        d = np.linalg.norm(r, axis = -1, keepdims = True)
+        gradient = spring_constant * (d - rest_length) / d * r
+    return np.array([gradient, -gradient])
+
+
+@derivatives.add_analytic_gradient(spring_gradient)
+def spring(q, p, *, spring_constant = 1, rest_length = 0):
+    '''spring_constant / 2 * (|q - p| - rest_length)^2'''
+    return spring_constant / 2 * (np.linalg.norm(q - p, axis = -1) - rest_length)**2
+
+
+def uniform_gravity_gradient(*qs, g = 9.8, masses = None):
+    masses = np.ones(len(qs)) if masses is None else masses
+    gradient = np.zeros((len(qs),) + np.shape(qs[0]))
+    gradient[..., 1] = g * np.reshape(masses, (len(qs),) + (1,) * (np.ndim(qs[0]) - 1))
+    return gradient
+
+
+@derivatives.add_analytic_gradient(uniform_gravity_gradient)
+def uniform_gravity(*qs, g = 9.8, masses = None):
+    '''g * (m_1 * y_1 + m_2 * y_2 + ...) for the heights y_i of the qs, all the masses default to 1'''
+    masses = np.ones(len(qs)) if masses is None else masses
+    return g * sum(m * q[..., 1] for m, q in zip(masses, qs))
+
+
+def lennard_jones_gradient(r, *, epsilon = 1, sigma = 1, cutoff = None):
+    cutoff = 2.5 * sigma if cutoff is None else cutoff
+    d2 = np.einsum('ij,ij->i', r, r)
+    x = (sigma**2 / d2)**3
+    dU_over_d = np.where(d2 < cutoff**2, 24 * epsilon * (x - 2 * x * x) / d2, 0)
+    return dU_over_d[:, np.newaxis] * r
+
+
+@derivatives.add_analytic_gradient(lennard_jones_gradient)
+def lennard_jones(r, *, epsilon = 1, sigma = 1, cutoff = None):
+    '''4 * epsilon * ((sigma / d)^12 - (sigma / d)^6) of the (M, 2) pair displacements r, for d below cutoff
+
+    Shifted to 0 at the cutoff, which defaults to 2.5 * sigma. This is a
+    vectorized cell-list pair potential, add it with vectorized = True.'''
+    cutoff = 2.5 * sigma if cutoff is None else cutoff
+    d2 = np.einsum('ij,ij->i', r, r)
+    x = (sigma**2 / d2)**3
+    x_cutoff = (sigma / cutoff)**6
+    return np.where(d2 < cutoff**2, 4 * epsilon * (x * x - x - x_cutoff * x_cutoff + x_cutoff), 0)
+
+
+spring.kernel = 'spring'
+uniform_gravity.kernel = 'uniform gravity'
+lennard_jones.kernel = 'lennard-jones'
+
+
+
+def kernel_parameters(function, kwargs):
+    '''the keyword arguments of the kernel function, with its defaults filled in'''
+    parameters = {name: parameter.default
+                  for name, parameter in inspect.signature(function).parameters.items()
+                  if parameter.kind == parameter.KEYWORD_ONLY}
+    parameters.update(kwargs)
+    return parameters
+
+
+def jit_supported(dynamical_system, integrator_code = None):
+    '''Whether dynamical_system.compile(jit = True) can run the system in Numba
+
+    It needs Numba, potentials that are all kernels (lennard_jones as a
+    vectorized cell-list pair potential, spring in exactly two coordinates)
+    and an integrator of phasespace.phase_space_integrator_dict.'''
+    import lagrangian.phasespace as phasespace
+
+    integrator_code = integrator_code or dynamical_system.integrator_code
+    if integrator_code not in phasespace.phase_space_integrator_dict:
+        return False
+    if dynamical_system.constraints or dynamical_system.inverse_distance_potentials:
+        return False
+
+    for potential in dynamical_system.potentials.values():
+        kernel = getattr(potential.potential_function, 'kernel', None)
+        if not (kernel == 'uniform gravity' or (kernel == 'spring' and len(potential.rows) == 2)):
+            return False
+
+    for potential in dynamical_system.cell_list_potentials.values():
+        if getattr(potential.potential_function, 'kernel', None) != 'lennard-jones' or not potential.vectorized:
+            return False
+
+    return _import_numba()
+
+
+
+def _kernel_forces(qs, constant_forces, springs, spring_parameters, lennard_jones_parameters,
+                   lower, box, periodic):
+    '''the (N, 2) forces of the kernels at qs
+
+    springs is the (S, 2) array of the rows of each spring and spring_parameters
+    the (S, 2) array of their spring constants and rest lengths.
+    lennard_jones_parameters is the (P, 3) array of epsilon, sigma and cutoff
+    of each Lennard-Jones potential.'''
+    N = qs.shape[0]
+    forces = constant_forces.copy()
+
+    for s in range(springs.shape[0]):
+        i, j = springs[s, 0], springs[s, 1]
+        spring_constant, rest_length = spring_parameters[s, 0], spring_parameters[s, 1]
+        r_x, r_y = qs[i, 0] - qs[j, 0], qs[i, 1] - qs[j, 1]
+        if rest_length == 0:
+            c = spring_constant
+        else:
+            d = math.sqrt(r_x * r_x + r_y * r_y)
+            c = spring_constant * (d - rest_length) / d
+        forces[i, 0] -= c * r_x
+        forces[i, 1] -= c * r_y
+        forces[j, 0] += c * r_x
+        forces[j, 1] += c * r_y
+
+    for p in range(lennard_jones_parameters.shape[0]):
+        epsilon = lennard_jones_parameters[p, 0]
+        sigma = lennard_jones_parameters[p, 1]
+        cutoff = lennard_jones_parameters[p, 2]
+
+        '''bin the qs into cells at least cutoff wide, as linked lists'''
+        N_x = max(1, int(box[0] // cutoff))
+        N_y = max(1, int(box[1] // cutoff))
+        cell_x = np.empty(N, dtype = np.int64)
+        cell_y = np.empty(N, dtype = np.int64)
+        head = np.full(N_x * N_y, -1, dtype = np.int64)
+        next_in_cell = np.empty(N, dtype = np.int64)
+        for a in range(N):
+            cell_x[a] = min(max(int((qs[a, 0] - lower[0]) / box[0] * N_x), 0), N_x - 1)
+            cell_y[a] = min(max(int((qs[a, 1] - lower[1]) / box[1] * N_y), 0), N_y - 1)
+            cell = cell_x[a] * N_y + cell_y[a]
+            next_in_cell[a] = head[cell]
+            head[cell] = a
+
+        '''each pair a < b in the same or neighboring cells once, with the
+        force on b the opposite of the one on a. Periodic boxes less than 3
+        cells across look at each cell once'''
+        for a in range(N):
+            first_x, last_x = cell_x[a] - 1, cell_x[a] + 1
+            if periodic and N_x < 3:
+                first_x, last_x = 0, N_x - 1
+            first_y, last_y = cell_y[a] - 1, cell_y[a] + 1
+            if periodic and N_y < 3:
+                first_y, last_y = 0, N_y - 1
+            
+            for n_x in range(first_x, last_x + 1):
+                if not periodic and (n_x < 0 or n_x >= N_x):
+                    continue
+                for n_y in range(first_y, last_y + 1):
+                    if not periodic and (n_y < 0 or n_y >= N_y):
+                        continue
+
+                    b = head[(n_x % N_x) * N_y + n_y % N_y]
+                    while b != -1:
+                        if b > a:
+                            r_x, r_y = qs[a, 0] - qs[b, 0], qs[a, 1] - qs[b, 1]
+                            if periodic:
+                                r_x -= box[0] * np.rint(r_x / box[0])
+                                r_y -= box[1] * np.rint(r_y / box[1])
+                            d2 = r_x * r_x + r_y * r_y
+                            if d2 < cutoff * cutoff:
+                                x = (sigma * sigma / d2)**3
+                                dU_over_d = 24 * epsilon * (x - 2 * x * x) / d2
+                                forces[a, 0] -= dU_over_d * r_x
+                                forces[a, 1] -= dU_over_d * r_y
+                                forces[b, 0] += dU_over_d * r_x
+                                forces[b, 1] += dU_over_d * r_y
+                        b = next_in_cell[b]
+
+    return forces
+
+
+def _boundary(qs, q_dots, lower, upper, periodic, wall_elasticity):
+    '''collisions.reflect_off_walls or wrap_into_box in place. Returns whether anything hit a wall'''
+    hit = False
+    for a in range(qs.shape[0]):
+        for k in range(2):
+            if periodic:
+                qs[a, k] = lower[k] + (qs[a, k] - lower[k]) % (upper[k] - lower[k])
+            elif qs[a, k] < lower[k]:
+                qs[a, k] = lower[k] + .0001
+                if q_dots[a, k] < 0:
+                    q_dots[a, k] *= - wall_elasticity
+                hit = True
+            elif qs[a, k] > upper[k]:
+                qs[a, k] = upper[k] - .0001
+                if q_dots[a, k] > 0:
+                    q_dots[a, k] *= - wall_elasticity
+                hit = True
+    return hit
+
+
+def _rk_steps(qs, q_dots, slope_qs, slope_q_dots, has_slope, N_steps, dt, a, b, fsal,
+              inverse_masses, constant_forces, springs, spring_parameters, lennard_jones_parameters,
+              lower, upper, periodic, wall_elasticity):
+    '''N_steps of PhaseSpace.rk_step and PhaseSpace.boundary
+
+    Returns the qs and q_dots after them, the fsal slope (and whether there
+    is one) and the number of force evaluations.'''
+    s = b.shape[0]
+    box = upper - lower
+    qs, q_dots = qs.copy(), q_dots.copy()
+    k_qs = np.empty((s,) + qs.shape)
+    k_q_dots = np.empty((s,) + qs.shape)
+    N_evaluations = 0
+
+    for step in range(N_steps):
+        for l in range(s):
+            if l == 0 and has_slope:
+                k_qs[0], k_q_dots[0] = slope_qs, slope_q_dots
+                continue
+
+            sample_qs, sample_q_dots = qs, q_dots
+            for m in range(l):
+                if a[l, m] != 0:
+                    sample_qs = sample_qs + (dt * a[l, m]) * k_qs[m]
+                    sample_q_dots = sample_q_dots + (dt * a[l, m]) * k_q_dots[m]
+            k_qs[l] = sample_q_dots
+            k_q_dots[l] = _kernel_forces(sample_qs, constant_forces, springs, spring_parameters,
+                                         lennard_jones_parameters, lower, box, periodic) * inverse_masses
+            N_evaluations += 1
+
+        step_qs, step_q_dots = np.zeros_like(qs), np.zeros_like(qs)
+        for l in range(s):
+            if b[l] != 0:
+                step_qs = step_qs + b[l] * k_qs[l]
+                step_q_dots = step_q_dots + b[l] * k_q_dots[l]
+        qs = qs + dt * step_qs
+        q_dots = q_dots + dt * step_q_dots
+
+        hit = _boundary(qs, q_dots, lower, upper, periodic, wall_elasticity)
+        has_slope = fsal and not hit
+        slope_qs, slope_q_dots = k_qs[s - 1].copy(), k_q_dots[s - 1].copy()
+
+    return qs, q_dots, slope_qs, slope_q_dots, has_slope, N_evaluations
+
+
+def _symplectic_steps(qs, q_dots, q_dotdots, has_q_dotdots, N_steps, dt, drifts, kicks,
+                      inverse_masses, constant_forces, springs, spring_parameters, lennard_jones_parameters,
+                      lower, upper, periodic, wall_elasticity):
+    '''N_steps of PhaseSpace.symplectic_step and PhaseSpace.boundary
+
+    Returns the qs and q_dots after them, the accelerations (and whether
+    there are any) and the number of force evaluations.'''
+    box = upper - lower
+    qs, q_dots = qs.copy(), q_dots.copy()
+    N_evaluations = 0
+
+    for step in range(N_steps):
+        for l in range(drifts.shape[0]):
+            if drifts[l] != 0:
+                qs = qs + (drifts[l] * dt) * q_dots
+                has_q_dotdots = False
+            if kicks[l] != 0:
+                if not has_q_dotdots:
+                    q_dotdots = _kernel_forces(qs, constant_forces, springs, spring_parameters,
+                                               lennard_jones_parameters, lower, box, periodic) * inverse_masses
+                    has_q_dotdots = True
+                    N_evaluations += 1
+                q_dots = q_dots + (kicks[l] * dt) * q_dotdots
+
+        if _boundary(qs, q_dots, lower, upper, periodic, wall_elasticity):
+            has_q_dotdots = False
+
+    return qs, q_dots, q_dotdots, has_q_dotdots, N_evaluations
+
+
+
+class KernelPhaseSpace(PhaseSpace):
+    '''The phase space of a system of kernels, run in Numba record_every steps at a time
+
+    See jit_supported for the systems it takes. The first run compiles the
+    Numba functions, which takes a few seconds.'''
+
+    def __init__(self, dynamical_system, integrator_code = None):
+        if not jit_supported(dynamical_system, integrator_code):
+            raise ValueError('the dynamical system has potentials that are not kernels, '
+                             'or an integrator the phase space does not run, see kernels.jit_supported')
+        super().__init__(dynamical_system, integrator_code)
+        _jit_kernels()
+
+        self.constant_forces = np.zeros((self.N, self.dim))
+        springs, spring_parameters = [], []
+        for potential in dynamical_system.potentials.values():
+            parameters = kernel_parameters(potential.potential_function, potential.kwargs)
+            if potential.potential_function.kernel == 'spring':
+                springs.append(potential.rows)
+                spring_parameters.append([parameters['spring_constant'], parameters['rest_length']])
+            else:
+                masses = parameters['masses']
+                masses = np.ones(len(potential.rows)) if masses is None else masses
+                np.subtract.at(self.constant_forces[:, 1], potential.rows,
+                               parameters['g'] * np.asarray(masses, dtype = float))
+
+        self.springs = np.array(springs, dtype = np.int64).reshape(-1, 2)
+        self.spring_parameters = np.array(spring_parameters, dtype = float).reshape(-1, 2)
+
+        lennard_jones_parameters = []
+        for potential in dynamical_system.cell_list_potentials.values():
+            parameters = kernel_parameters(potential.potential_function, potential.kwargs)
+            cutoff = parameters['cutoff'] or 2.5 * parameters['sigma']
+            lennard_jones_parameters.append([parameters['epsilon'], parameters['sigma'], cutoff])
+        self.lennard_jones_parameters = np.array(lennard_jones_parameters, dtype = float).reshape(-1, 3)
+
+        self.lower = np.array([self.xlim[0], self.ylim[0]], dtype = float)
+        self.upper = np.array([self.xlim[1], self.ylim[1]], dtype = float)
+        self.column_inverse_masses = (1 / dynamical_system.mass_array)[:, np.newaxis]
+
+
+    def forces(self, y):
+        self.N_force_evaluations += 1
+        qs = y[:self.size].reshape(self.N, self.dim)
+        return _kernel_forces(qs, self.constant_forces, self.springs, self.spring_parameters,
+                              self.lennard_jones_parameters, self.lower, self.upper - self.lower,
+                              self.periodic).ravel()
+
+
+    def steps(self, qs, q_dots, cache, N_steps):
+        '''N_steps steps in Numba. cache is what the last call returned with the
+        qs and q_dots (the fsal slope or the accelerations), or None'''
+        kernel_arguments = (self.column_inverse_masses, self.constant_forces, self.springs,
+                            self.spring_parameters, self.lennard_jones_parameters,
+                            self.lower, self.upper, self.periodic, float(self.wall_elasticity))
+        has_cache = cache is not None
+
+        if isinstance(self.scheme, integrators.ButcherTableau):
+            slope_qs, slope_q_dots = cache if has_cache else (qs, q_dots)
+            qs, q_dots, slope_qs, slope_q_dots, has_cache, N_evaluations = \
+                _rk_steps(qs, q_dots, slope_qs, slope_q_dots, has_cache, N_steps, self.dt,
+                          self.scheme.a, self.scheme.b, self.scheme.fsal, *kernel_arguments)
+            cache = (slope_qs, slope_q_dots) if has_cache else None
+        else:
+            q_dotdots = cache if has_cache else qs
+            qs, q_dots, q_dotdots, has_cache, N_evaluations = \
+                _symplectic_steps(qs, q_dots, q_dotdots, has_cache, N_steps, self.dt,
+                                  np.array(self.scheme.drifts, dtype = float),
+                                  np.array(self.scheme.kicks, dtype = float),
+                                  *kernel_arguments)
+            cache = q_dotdots if has_cache else None
+
+        self.N_force_evaluations += N_evaluations
+        return qs, q_dots, cache
+
+
+    def iter_dynamics(self, total_time = None, record_every = None, y = None):
+        '''PhaseSpace.iter_dynamics, taking the record_every steps between records in one Numba call'''
+        dt = self.dt
+        N_steps = math.inf if total_time is None else math.ceil(total_time / dt)
+        record_every = record_every or self.record_every
+
+        qs, q_dots = self.split(self.initial_y if y is None else y)
+        cache = None
+        self.N_force_evaluations = 0
+        self.N_steps_taken = 0
+
+        while self.N_steps_taken + record_every <= N_steps:
+            qs, q_dots, cache = self.steps(qs, q_dots, cache, record_every)
+            self.N_steps_taken += record_every
+            yield np.concatenate([qs.ravel(), q_dots.ravel()])
+
+        if self.N_steps_taken < N_steps:
+            '''the steps after the last record'''
+            self.steps(qs, q_dots, cache, N_steps - self.N_steps_taken)
+            self.N_steps_taken = N_steps
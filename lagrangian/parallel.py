@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Domain decomposition of the cell-list forces across worker processes.
+
+The cell lists grid is cut into slabs of cell columns, one per worker, and
+each worker computes the pair forces of the neighbor pairs whose first
+particle is in its slab. The forward neighbor cells of the last column of a
+slab are the halo: the first column of the next slab, which the worker only
+reads. The positions are in a multiprocessing.shared_memory block all the
+workers read, and each worker adds its forces into an accumulator of its own
+in another one, so nothing needs a lock. The forces are the sum of the
+accumulators.
+
+The workers are forked from the process running the dynamics, so they get the
+potentials without pickling them. This needs the 'fork' start method (Linux).
+"""
+
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+
+def _worker(connection, positions, accumulator, dynamical_system):
+    '''The loop of a worker: takes its pairs, and computes its forces when asked
+
+    If anything raises, the exception and its traceback go back to the parent
+    in place of 'done', and the worker quits.'''
+    i = j = np.zeros(0, dtype = int)
+    N, dim = positions.shape
+
+    try:
+        while True:
+            message = connection.recv()
+            if message[0] == 'pairs':
+                _, i, j = message
+
+            elif message[0] == 'forces':
+                _, groups = message
+                accumulator[:] = 0
+                for potential in dynamical_system.cell_list_potentials.values():
+                    if groups is not None and potential.group not in groups:
+                        continue
+                    gradients = potential.pair_gradients(positions, i, j, dynamical_system.periodic_box)
+                    for k in range(dim):
+                        accumulator[:, k] += np.bincount(j, gradients[:, k], minlength = N) \
+                                           - np.bincount(i, gradients[:, k], minlength = N)
+                connection.send('done')
+
+            elif message[0] == 'stop':
+                return
+
+    except Exception as exception:
+        text = traceback.format_exc()
+        try:
+            connection.send(('error', exception, text))
+        except Exception:
+            connection.send(('error', None, text))
+
+    finally:
+        connection.close()
+
+
+class WorkerError(RuntimeError):
+    '''A worker failed. The message is its traceback'''
+
+
+class ParallelCellListForces:
+    '''The worker processes computing the cell-list forces of a dynamical system'''
+
+    def __init__(self, dynamical_system, N_workers):
+        self.dynamical_system = dynamical_system
+        self.N_workers = N_workers
+        self.pairs = None
+        self.closed = False
+
+        N, dim = dynamical_system.initial_state.qs.array.shape
+        self._positions_memory = shared_memory.SharedMemory(create = True, size = N * dim * 8)
+        self._forces_memory = shared_memory.SharedMemory(create = True, size = N_workers * N * dim * 8)
+        self.positions = np.ndarray((N, dim), buffer = self._positions_memory.buf)
+        self.accumulators = np.ndarray((N_workers, N, dim), buffer = self._forces_memory.buf)
+
+        context = multiprocessing.get_context('fork')
+        self.connections, self.workers = [], []
+        for w in range(N_workers):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target = _worker,
+                                     args = (worker_connection, self.positions,
+                                             self.accumulators[w], dynamical_system),
+                                     daemon = True)
+            worker.start()
+            worker_connection.close()
+            '''the worker holds the only other end now, so recv raises EOFError if it dies'''
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+
+    def decompose(self, pairs):
+        '''Hands each worker the pairs of its slab
+
+        The pairs are sorted by the cell column of their first particle, and cut
+        into N_workers runs of neighboring columns with equal numbers of pairs,
+        so the slabs are balanced by work rather than by area.'''
+        i, j = pairs
+        neighbor_lists = self.dynamical_system.neighbor_lists
+        columns = neighbor_lists.cells[i] // neighbor_lists.N_y
+        order = np.argsort(columns, kind = 'stable')
+
+        for connection, slab in zip(self.connections, np.array_split(order, self.N_workers)):
+            connection.send(('pairs', i[slab], j[slab]))
+        self.pairs = pairs
+
+
+    def forces(self, qs_array, pairs, groups = None):
+        '''the (N, dim) array of the forces of the cell-list potentials in groups'''
+        if pairs is not self.pairs:
+            self.decompose(pairs)
+
+        self.positions[:] = qs_array
+        for connection in self.connections:
+            connection.send(('forces', groups))
+        replies = []
+        for w, connection in enumerate(self.connections):
+            try:
+                replies.append(connection.recv())
+            except EOFError:
+                replies.append(('error', None, f'worker {w} died without replying'))
+
+        for reply in replies:
+            if reply != 'done':
+                _, exception, text = reply
+                if exception is None:
+                    raise WorkerError(text)
+                raise exception from WorkerError(text)
+        return self.accumulators.sum(axis = 0)
+
+
+    def close(self, timeout = 5):
+        '''Stops the workers and frees the shared memory, also when a worker has failed'''
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            for connection in self.connections:
+                try:
+                    connection.send(('stop',))
+                except (BrokenPipeError, OSError):
+                    pass
+            for connection, worker in zip(self.connections, self.workers):
+                worker.join(timeout)
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+                connection.close()
+
+        finally:
+            for memory in (self._positions_memory, self._forces_memory):
+                memory.close()
+                memory.unlink()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Particle-mesh (PM) solver for smooth long range inverse distance potentials
+
+    U = coefficient * s_i * s_j / sqrt(|q_i - q_j|^2 + softening^2)
+
+The charges s_i are spread onto a grid over xlim x ylim (cloud in cell),
+the field is the convolution of the grid charges with the gradient of the
+Green's function 1/r, done with numpy.fft, and it is interpolated back to the
+particles with the same cloud in cell weights. That is O(N + G log G) for G
+grid points, against O(N log N) for barneshut, and it blurs out everything
+below the grid spacing, so it is for many particles in smooth fields
+(self-gravitating or charged gases), not for close encounters.
+
+In a walled box the grid is zero padded to twice its size so the convolution
+doesn't wrap around. In a periodic box it does, and each particle feels the
+nearest image of the others (there is no Ewald sum over all the images).
+"""
+
+import numpy as np
+
+
+
+class ParticleMesh:
+    '''The grid over xlim x ylim and the Fourier transforms of the field kernels
+
+    N_grid is the number of grid points along x and along y (an int for both).
+    softening defaults to the grid spacing.
+    '''
+
+    def __init__(self, xlim, ylim, N_grid = 64, periodic = False, softening = None):
+        self.xlim = xlim
+        self.ylim = ylim
+        self.periodic = periodic
+        self.N_x, self.N_y = (N_grid, N_grid) if np.isscalar(N_grid) else N_grid
+
+        self.corner = np.array([xlim[0], ylim[0]], dtype = float)
+        lengths = np.array([xlim[1] - xlim[0], ylim[1] - ylim[0]], dtype = float)
+        self.shape = np.array([self.N_x, self.N_y])
+        self.spacing = lengths / self.shape if periodic else lengths / (self.shape - 1)
+        '''walled grids have points on both walls, periodic ones don't repeat the last'''
+
+        self.softening = self.spacing.max() if softening is None else softening
+
+        self.padded_shape = tuple(self.shape if periodic else 2 * self.shape)
+        self.kernel_transforms = self._kernel_transforms()
+
+
+    def _kernel_transforms(self):
+        '''rfft2 of the x and y components of the gradient of 1/sqrt(r^2 + softening^2) on the padded grid
+
+        Grid point k stands for the offset k * spacing, or (k - size) * spacing
+        past the middle, so the convolution gets the offsets of either sign.
+        Half way across an even grid the offset is as much +size/2 as -size/2,
+        and the component along it is left 0.'''
+        offsets = []
+        for size, spacing in zip(self.padded_shape, self.spacing):
+            k = np.arange(size)
+            offsets.append(np.where(k < (size + 1) // 2, k, k - size) * spacing)
+
+        r = np.meshgrid(*offsets, indexing = 'ij')
+        d3 = (r[0]**2 + r[1]**2 + self.softening**2)**1.5
+        
+        kernels = [- r_k / d3 for r_k in r]
+        for k, size in enumerate(self.padded_shape):
+            if size % 2 == 0:
+                np.moveaxis(kernels[k], k, 0)[size // 2] = 0
+        return [np.fft.rfft2(kernel) for kernel in kernels]
+
+
+    def cloud_in_cell(self, qs_array):
+        '''The 4 grid points around each q and their weights, as (N, 4) arrays
+
+        The grid points are flat indices into the padded grid.'''
+        x = (qs_array - self.corner) / self.spacing
+        lower = np.floor(x).astype(int)
+        frac = x - lower
+
+        if self.periodic:
+            lower %= self.shape
+            upper = (lower + 1) % self.shape
+        else:
+            lower = np.clip(lower, 0, self.shape - 2)
+            frac = np.clip(x - lower, 0, 1)
+            upper = lower + 1
+
+        N_y = self.padded_shape[1]
+        points = np.stack([lower[:, 0] * N_y + lower[:, 1],
+                           lower[:, 0] * N_y + upper[:, 1],
+                           upper[:, 0] * N_y + lower[:, 1],
+                           upper[:, 0] * N_y + upper[:, 1]], axis = 1)
+        weights = np.stack([(1 - frac[:, 0]) * (1 - frac[:, 1]),
+                            (1 - frac[:, 0]) * frac[:, 1],
+                            frac[:, 0] * (1 - frac[:, 1]),
+                            frac[:, 0] * frac[:, 1]], axis = 1)
+        return points, weights
+
+
+    def forces(self, qs_array, charges, coefficient):
+        '''the (N, 2) array of the forces of the inverse distance potential on the qs'''
+        points, weights = self.cloud_in_cell(qs_array)
+
+        density = np.bincount(points.ravel(),
+                              (weights * charges[:, np.newaxis]).ravel(),
+                              minlength = np.prod(self.padded_shape)).reshape(self.padded_shape)
+        density_transform = np.fft.rfft2(density)
+
+        forces = np.empty((len(qs_array), 2))
+        for k, kernel_transform in enumerate(self.kernel_transforms):
+            field = np.fft.irfft2(density_transform * kernel_transform, s = self.padded_shape)
+            '''the force on q is -coefficient * s * (the gradient of the potential of the others)'''
+            forces[:, k] = - coefficient * charges * (field.ravel()[points] * weights).sum(axis = 1)
+        return forces
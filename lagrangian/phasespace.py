@@ -7,36 +7,285 @@ Created on Mon Dec 21 17:47:39 2020
 
 The main job of the phase space is the function that computes forces.
 The phase space will also be responsible for running the dynamics, i.e.
-passing the forces to the integrator and adding the next state into a 
+passing the forces to the integrator and adding the next state into a
 trajectories object.
 
+The phase space is a dynamical system compiled down to arrays. A point of
+phase space is the flat vector
 
+    y = (qs.ravel(), q_dots.ravel())
+
+of length 2 * N * dim. The coordinate names of the potentials are turned into
+rows once, when the phase space is made, and the potentials are sorted by
+kind (see potential_kinds), so forces(y) is a few array operations per kind
+and the integrators step y with no States, Coordinates or dicts in between.
+
+basic usage:
+
+phase_space = dynamical_system.compile()
+phase_space.run_dynamics(total_time)
+dynamical_system.display()
 """
 
-import lagrangian.integrators as integrators
+import math
 
 import numpy as np
-from itertools import product
-    
-integrator_dict = integrators.integrator_dict
+from tqdm import tqdm
+
+import lagrangian.integrators as integrators
+import lagrangian.collisions as collisions
+from lagrangian.state import State
+
+
+
+potential_kinds = ('one-body', 'bonded', 'pair', 'N-body')
+'''the potentials of add_potential in one coordinate are one-body, in more
+than one bonded. The cell-list pair potentials are pair potentials, and the
+inverse distance ones (barnes-hut, direct or particle mesh) N-body. The
+one-body and bonded ones come as potential sets, see potentials.PotentialSet'''
+
+
+forward_euler_tableau = integrators.ButcherTableau(a = [[0.0]],
+                                                   b = [1.0])
+
+midpoint_rule_tableau = integrators.ButcherTableau(a = [[0.0, 0.0],
+                                                        [0.5, 0.0]
+                                                        ],
+                                                   b = [0.0, 1.0])
+
+semi_implicit_euler = integrators.SymplecticComposition(drifts = [0, 1],
+                                                        kicks = [1, 0])
+'''kick, then drift with the new q_dots'''
+
+
+phase_space_integrator_dict = {'forward euler': forward_euler_tableau,
+                               'midpoint rule': midpoint_rule_tableau,
+                               'rk45': integrators.rk4_tableau,
+                               'ssprk3': integrators.ssprk3_tableau,
+                               'bogacki-shampine': integrators.bogacki_shampine_tableau,
+                               'dormand-prince': integrators.dormand_prince_tableau,
+                               'velocity verlet': integrators.velocity_verlet,
+                               'leapfrog': integrators.leapfrog,
+                               'yoshida4': integrators.yoshida4,
+                               'forest-ruth': integrators.forest_ruth,
+                               'semi-implicit euler': semi_implicit_euler
+                               }
+'''The integrators of integrators.integrator_dict that the phase space runs on
+arrays, by their Butcher tableau or symplectic composition. 'dormand-prince'
+takes fixed dt steps here.'''
+
+
 
 class PhaseSpace:
-    def __init__(self, particle_system,
-                 *,
-                 xlim = (-10,10), 
-                 ylim = (-10,10), 
-                 drag = 0,
-                 g = 9.8,
-                 dt = 1/60,
-                 integrator_code = 'ssprk3'):
-        
-        self.xlim = xlim
-        self.ylim = ylim
-        self.drag = drag
-        self.g = g
-        self.dt = dt
-        self.integrator = integrator_dict[integrator_code]
-        
-        
-    
-    
\ No newline at end of file
+    '''The forces and the integrator of dynamical_system, on flat phase space vectors y
+
+    The potentials are the ones of the dynamical system when it is compiled.
+    integrator_code defaults to the one of the dynamical system, and must be
+    in phase_space_integrator_dict. Constraints aren't supported.
+    '''
+
+    def __init__(self, dynamical_system, integrator_code = None):
+        if dynamical_system.constraints:
+            raise ValueError('constraints are not supported by the phase space')
+
+        integrator_code = integrator_code or dynamical_system.integrator_code
+        try:
+            self.scheme = phase_space_integrator_dict[integrator_code]
+        except(KeyError):
+                raise KeyError(integrator_code,
+                               ' not found. The valid phase space integrator keys are ',
+                               phase_space_integrator_dict.keys())
+
+        self.dynamical_system = dynamical_system
+        self.N, self.dim = dynamical_system.initial_state.qs.array.shape
+        self.size = self.N * self.dim
+        self.inverse_masses = np.repeat(1 / dynamical_system.mass_array, self.dim)
+        '''1/m for each entry of the flat qs'''
+
+        self.dt = dynamical_system.dt
+        self.record_every = dynamical_system.record_every
+        self.xlim = dynamical_system.xlim
+        self.ylim = dynamical_system.ylim
+        self.wall_elasticity = dynamical_system.wall_elasticity
+        self.periodic = dynamical_system.periodic
+        self.periodic_box = dynamical_system.periodic_box
+
+        self.one_body, self.bonded = [], []
+        for potential_set in dynamical_system.potential_sets:
+            if potential_set.rows_array.shape[1] == 1:
+                self.one_body.append(potential_set)
+            else:
+                self.bonded.append(potential_set)
+        self.pair = list(dynamical_system.cell_list_potentials.values())
+        self.N_body = list(dynamical_system.inverse_distance_potentials.values())
+
+        self.terms = self.one_body + self.bonded
+        self.rows = np.concatenate([potential_set.rows for potential_set in self.terms] + 
+                                   [np.zeros(0, dtype = int)])
+        '''the rows the gradients of the one-body and bonded potentials go to, in order'''
+
+        self.neighbor_lists = dynamical_system.new_neighbor_lists() if self.pair else None
+        self.pairs = None
+
+        self.initial_y = self.from_state(dynamical_system.initial_state)
+        self.N_force_evaluations = 0
+        self.N_steps_taken = 0
+
+
+    def split(self, y):
+        '''the (N, dim) qs and q_dots of y, as views'''
+        qs_and_q_dots = y.reshape(2, self.N, self.dim)
+        return qs_and_q_dots[0], qs_and_q_dots[1]
+
+
+    def from_state(self, state):
+        return np.concatenate([state.qs.array.ravel(), state.q_dots.array.ravel()])
+
+
+    def to_state(self, y):
+        return State.from_arrays(*self.split(y))
+
+
+    def forces(self, y):
+        '''the flat array of the forces at y (which only depend on its qs, so y can be just the flat qs)'''
+        self.N_force_evaluations += 1
+        N, dim = self.N, self.dim
+        qs = y[:self.size].reshape(N, dim)
+        forces = np.zeros((N, dim))
+
+        if len(self.rows):
+            '''every one-body and bonded gradient, scattered in one go'''
+            gradients = np.concatenate([potential_set.gradient_array(qs) for potential_set in self.terms])
+            for k in range(dim):
+                forces[:, k] -= np.bincount(self.rows, gradients[:, k], minlength = N)
+
+        if self.pair:
+            i, j = self.pairs
+            for potential in self.pair:
+                gradients = potential.pair_gradients(qs, i, j, self.periodic_box)
+                for k in range(dim):
+                    forces[:, k] += np.bincount(j, gradients[:, k], minlength = N) \
+                                  - np.bincount(i, gradients[:, k], minlength = N)
+
+        for potential in self.N_body:
+            forces += potential.forces(qs)
+
+        return forces.ravel()
+
+
+    def slope(self, y):
+        '''dy/dt = (q_dots, forces / m)'''
+        return np.concatenate([y[self.size:], self.forces(y) * self.inverse_masses])
+
+
+    def rk_step(self, y, tableau, dt, slope = None):
+        '''integrators.rk_next on y. slope is f(y) if it is already known
+
+        Returns the next y and, for first same as last tableaux, its slope.'''
+        a = tableau.a
+        k = []
+        for l in range(tableau.s):
+            if l == 0 and slope is not None:
+                k.append(slope)
+                continue
+
+            sample = y
+            for m in range(l):
+                if a[l, m] != 0:
+                    sample = sample + (dt * a[l, m]) * k[m]
+            k.append(self.slope(sample))
+
+        y_next = y + dt * sum(b_l * k_l for b_l, k_l in zip(tableau.b, k) if b_l != 0)
+        return y_next, (k[-1] if tableau.fsal else None)
+
+
+    def symplectic_step(self, y, composition, dt, q_dotdots = None):
+        '''integrators.symplectic_next on y. q_dotdots are the accelerations at y if already known
+
+        Returns the next y and the accelerations at it, if the step ends with a kick.'''
+        qs, q_dots = y[:self.size], y[self.size:]
+        for drift, kick in zip(composition.drifts, composition.kicks):
+            if drift != 0:
+                qs = qs + (drift * dt) * q_dots
+                q_dotdots = None
+            if kick != 0:
+                if q_dotdots is None:
+                    q_dotdots = self.forces(qs) * self.inverse_masses
+                q_dots = q_dots + (kick * dt) * q_dotdots
+
+        return np.concatenate([qs, q_dots]), q_dotdots
+
+
+    def step(self, y, dt, cache = None):
+        '''One step of the integrator. cache is what the last step returned
+        along with y (the fsal slope, or the accelerations), or None'''
+        if isinstance(self.scheme, integrators.ButcherTableau):
+            return self.rk_step(y, self.scheme, dt, cache)
+        return self.symplectic_step(y, self.scheme, dt, cache)
+
+
+    def boundary(self, y):
+        '''the walls or the periodic box, as in the dynamical system
+
+        With walls, y itself is returned when nothing hit one.'''
+        qs, q_dots = self.split(y)
+        if self.periodic:
+            qs = collisions.wrap_into_box(qs, self.xlim, self.ylim)
+        else:
+            reflected_qs, q_dots = collisions.reflect_off_walls(qs, q_dots, self.xlim, self.ylim, self.wall_elasticity)
+            if reflected_qs is qs:
+                return y
+            qs = reflected_qs
+
+        return np.concatenate([qs.ravel(), q_dots.ravel()])
+
+
+    def iter_dynamics(self, total_time = None, record_every = None, y = None):
+        '''DynamicalSystem.iter_dynamics on arrays: yields every record_every-th y
+
+        y defaults to the initial state of the dynamical system.'''
+        dt = self.dt
+        N_steps = math.inf if total_time is None else math.ceil(total_time / dt)
+        record_every = record_every or self.record_every
+
+        y = self.initial_y if y is None else y
+        cache = None
+        self.N_force_evaluations = 0
+        self.N_steps_taken = 0
+
+        step = 0
+        while step < N_steps:
+            if self.pair:
+                self.pairs = self.neighbor_lists.update(self.to_state(y))
+
+            y_next, cache = self.step(y, dt, cache)
+            y = self.boundary(y_next)
+            if y is not y_next and not self.periodic:
+                '''the forces are periodic, but a bounce off a wall changes the
+                q_dots the fsal slope was taken at'''
+                cache = None
+
+            step += 1
+            self.N_steps_taken = step
+
+            if step % record_every == 0:
+                yield y
+
+
+    def run_dynamics(self, total_time, progress = True):
+        '''DynamicalSystem.run_dynamics on arrays, storing the states in dynamical_system.trajectory_data'''
+        dynamical_system = self.dynamical_system
+        N_records = math.ceil(total_time / self.dt) // self.record_every
+
+        trajectory_data = dynamical_system.trajectory_storage(dynamical_system, N_records + 1)
+
+        for y in tqdm(self.iter_dynamics(total_time), total = N_records, disable = not progress):
+            trajectory_data.append(self.to_state(y))
+
+        trajectory_data.flush()
+        dynamical_system.trajectory_data = trajectory_data
+        dynamical_system.N_force_evaluations = self.N_force_evaluations
+        dynamical_system.N_steps_taken = self.N_steps_taken
+
+        if progress:
+            print("dynamics finished!\r")
@@ -13,11 +13,20 @@ import numpy as np
 import math
 
 import lagrangian.derivatives as derivatives
+import lagrangian.collisions as collisions
+import lagrangian.barneshut as barneshut
+import lagrangian.particlemesh as particlemesh
+from lagrangian.state import Coordinates
 
 np.seterr(divide = 'raise', invalid = 'raise')
 
 epsilon = np.finfo(float).eps
 
+potential_groups = ('fast', 'slow')
+'''Every potential is in one of these groups, 'fast' unless it was added with 
+group = 'slow'. The 'respa' integrator evaluates the slow group only once 
+every outer step, see integrators.respa_next'''
+
 def single_variable_difference_quotient(f, x):
         """See wikipedia article on numerical differentiation for this choice 
         of dx. Basically we use square root of machine epsilon
@@ -63,31 +72,42 @@ def single_var_gradient(f, q):
 class Gradient:
     
     
-    def __init__(self, function, args_list, **kwargs):
+    def __init__(self, function, args_list, gradient = None, **kwargs):
+        '''gradient is an optional analytic gradient of function, see 
+        derivatives.add_analytic_gradient'''
         self.function = function
         self.args_list = args_list
         self.kwargs = kwargs
+        self.analytic_gradient = gradient
+        
+        self.autodiff = derivatives.AutodiffSwitch(function)
+        '''whether this gradient still tries automatic differentiation'''
+        self.full_gradient = derivatives.get_full_gradient(function, gradient, self.autodiff)
     
     
     def __getitem__(self, i):
+        '''the gradient wrt. the coordinate named i, via derivatives.get_gradient_i
+        
+        so it is computed with automatic differentiation when the function 
+        allows, and difference quotients otherwise (unless it is analytic)'''
+        gradient_i = derivatives.get_gradient_i(self.function, 
+                                                self.args_list.index(i), 
+                                                self.analytic_gradient,
+                                                self.autodiff)
         
         def grad_i(qs):
-            qs = qs
-            args = {i : qs[i] for i in self.args_list}
-            kwargs = self.kwargs
-            function = self.function
-            
-            def single_variable_function(x) :
-                args[i] = x
-                args_tuple = (args[i] for i in args.keys())
-                return function(*args_tuple, **kwargs)
-            
-            return single_var_gradient(single_variable_function, qs[i])
-            
+            args = (qs[j] for j in self.args_list)
+            return gradient_i(*args, **self.kwargs)
         
         return grad_i 
     
     
+    def full(self, qs):
+        '''the gradients wrt. every coordinate in args_list, as an (n_args, dim) array'''
+        args = [qs[j] for j in self.args_list]
+        return self.full_gradient(*args, **self.kwargs)
+    
+    
     def add_gradients(self, function, args_list, **kwargs):
         function.gradient = self.Gradient(function, args_list, **kwargs)
         return function
@@ -95,20 +115,33 @@ class Gradient:
 
 
 class Potential:
-    def __init__(self, potential_function, coordinates, **kwargs):
+    group = 'fast'
+    
+    def __init__(self, potential_function, coordinates, gradient = None, vectorized = False, **kwargs):
         '''The args are strings that hold the name of each coordinate appearing in the input variables to the potential function.
         
+        gradient is an optional analytic gradient, see derivatives.add_analytic_gradient.
+        
+        If vectorized is True, potential_function also takes (M, 2) arrays of 
+        M values of each coordinate and returns the (M,) array of the 
+        potentials (an analytic gradient then returns (n_args, M, 2)), so an 
+        ensemble of M replicas is done in one call, see batch_gradient.
         
         **kwargs should hold any additional arguments passed to the potential.
         We might need to manage where they come from...'''
         
         self.potential_function = potential_function
         self.coordinates = coordinates
+        self.vectorized = vectorized
         self.kwargs = kwargs
         
-        self.gradient = Gradient(potential_function, coordinates, **kwargs)
-        
+        self.gradient = Gradient(potential_function, coordinates, gradient, **kwargs)
+        self.batch_autodiff = derivatives.AutodiffSwitch(potential_function)
+        self.hessian_autodiff = derivatives.AutodiffSwitch(gradient or getattr(potential_function, 'full_gradient', None))
+        '''whether batch_gradient and hessian still try automatic differentiation'''
         
+        self.rows = [Coordinates.index[i] for i in coordinates]
+        '''the rows of the coordinates in Coordinates arrays, for scattering the gradient'''
         
         
         
@@ -117,28 +150,348 @@ class Potential:
         return self.potential_function(*args, **self.kwargs)
     
     
+    def full_gradient(self, qs):
+        '''Returns the gradient wrt. all the coordinates at once, as an (n_args, dim) array
+        
+        Row k is the gradient wrt. self.coordinates[k]. With automatic 
+        differentiation this takes one evaluation of the potential, instead of 
+        one (or four, with difference quotients) per coordinate.'''
+        return self.gradient.full(qs)
+    
+    
+    def batch_gradient(self, qs_array):
+        '''full_gradient for an (M, N, dim) array of the qs of M replicas, as an (n_args, M, dim) array
+        
+        Vectorized potentials do all the replicas in one evaluation, the others
+        one replica at a time.'''
+        args = [qs_array[:, row] for row in self.rows]
+        if self.vectorized:
+            return derivatives.batched_full_gradient(self.potential_function, 
+                                                     args, 
+                                                     self.gradient.analytic_gradient, 
+                                                     self.batch_autodiff,
+                                                     **self.kwargs)
+        
+        return np.stack([self.gradient.full_gradient(*(arg[m] for arg in args), **self.kwargs) 
+                         for m in range(len(qs_array))], axis = 1)
+    
+    
+    def hessian(self, qs_array):
+        '''Returns the Hessian wrt. all the coordinates, as an (n_args * dim, n_args * dim) array
+        
+        Entry (k * dim + a, l * dim + b) is the second derivative wrt. 
+        component a of self.coordinates[k] and component b of 
+        self.coordinates[l]. An analytic gradient is differentiated 
+        automatically when it allows, otherwise this is the central difference
+        quotient of full_gradient, symmetrized.'''
+        args = qs_array[self.rows].astype(float)
+        
+        analytic_gradient = self.gradient.analytic_gradient or \
+            getattr(self.potential_function, 'full_gradient', None)
+        if analytic_gradient is not None and self.hessian_autodiff.on:
+            try:
+                return derivatives.dual_jacobian(analytic_gradient, args, **self.kwargs)
+            except (FloatingPointError, ZeroDivisionError):
+                pass
+            except derivatives.autodiff_errors:
+                self.hessian_autodiff.on = False
+        
+        n = args.size
+        step = epsilon**(1/3) * np.maximum(1, abs(args.ravel()))
+        
+        hessian = np.empty((n, n))
+        for m in range(n):
+            forward, backward = args.copy(), args.copy()
+            forward.flat[m] += step[m]
+            backward.flat[m] -= step[m]
+            hessian[:, m] = (np.asarray(self.gradient.full_gradient(*forward, **self.kwargs)) - 
+                             np.asarray(self.gradient.full_gradient(*backward, **self.kwargs))).ravel() / (2 * step[m])
+        return (hessian + hessian.T) / 2
+    
+    
+    
+def _same_kwargs(kwargs, other_kwargs):
+    '''whether two potentials were given the same keyword arguments (arrays compared by value)'''
+    if kwargs.keys() != other_kwargs.keys():
+        return False
+    for name, value in kwargs.items():
+        other_value = other_kwargs[name]
+        if value is other_value:
+            continue
+        try:
+            if not np.array_equal(value, other_value):
+                return False
+        except Exception:
+            return False
+    return True
+
+
+class PotentialSet:
+    group = 'fast'
+    
+    def __init__(self, potential):
+        '''Potentials with the same function, kwargs, gradient and group, differing only in their coordinates
+        
+        Adding a potential for every pair of some coordinates (with 
+        itertools.combinations, say) makes O(N^2) Potentials of a single 
+        function. Their set keeps the rows of each one's coordinates as one 
+        (K, n_args) index array, rows_array, and when the function is 
+        vectorized (it takes (K, 2) arrays of the values of each coordinate to
+        the (K,) array of the potentials, like np.linalg.norm(q - p, axis = -1)
+        does) all K gradients come from one batched evaluation, see 
+        derivatives.batched_full_gradient. Functions that aren't are found out
+        on their first evaluation, by comparing with the potentials one at a 
+        time (see takes_batches), and keep being evaluated one potential at a
+        time.'''
+        self.potential_function = potential.potential_function
+        self.kwargs = potential.kwargs
+        self.vectorized = potential.vectorized
+        self.gradient = potential.gradient
+        self.group = potential.group
+        
+        self.autodiff = derivatives.AutodiffSwitch(self.potential_function)
+        '''whether the batched gradients still try automatic differentiation'''
+        
+        self.potentials = []
+        self.batched = True if potential.vectorized else None
+        '''whether the function takes batches, None until it has been tried'''
+        self.add(potential)
+        
+        
+    @staticmethod
+    def key(potential):
+        '''potentials in the same set have the same key (and the same kwargs)'''
+        return (potential.potential_function, 
+                potential.gradient.analytic_gradient, 
+                potential.vectorized, 
+                potential.group, 
+                len(potential.rows))
+    
+    
+    def matches(self, potential):
+        return self.key(potential) == self.key(self.potentials[0]) and \
+            _same_kwargs(self.kwargs, potential.kwargs)
+    
+    
+    def add(self, potential):
+        self.potentials.append(potential)
+        self.rows_array = np.array([member.rows for member in self.potentials], dtype = int)
+        self.rows = self.rows_array.ravel()
+        '''the row of each gradient of full_gradient, potential by potential'''
+    
+    
+    def __len__(self):
+        return len(self.potentials)
+    
+    
+    def __call__(self, qs):
+        return sum(potential(qs) for potential in self.potentials)
+    
+    
+    def batched_gradients(self, args):
+        '''the (n_args, K, dim) gradients of the potentials on the (K, dim) args, from one batched evaluation
+        
+        Raises a ValueError if they don't come out with that shape.'''
+        gradients = derivatives.batched_full_gradient(self.potential_function, 
+                                                      args, 
+                                                      self.gradient.analytic_gradient, 
+                                                      self.autodiff,
+                                                      **self.kwargs)
+        if gradients.shape != (len(args),) + args[0].shape:
+            raise ValueError(f"batched gradients of shape {gradients.shape}, "
+                             f"rather than {(len(args),) + args[0].shape}")
+        return gradients
+    
+    
+    def takes_batches(self, args):
+        '''Tries the function on the args of all the potentials at once
+        
+        It takes batches if it gives the (K,) array of their potentials, and the
+        batched gradients are theirs as well. This is checked at the args and 
+        again at randomly perturbed ones, since a function that isn't 
+        vectorized (one indexing q[0] for the x coordinate, say) can still 
+        agree with them when the coordinates happen to line up with the axes.'''
+        if len(self) < 2:
+            return False
+        
+        rng = np.random.default_rng(0)
+        perturbed_args = [arg + (1 + np.abs(arg).max()) * rng.uniform(-.1, .1, arg.shape) for arg in args]
+        try:
+            for test_args in [args, perturbed_args]:
+                values = self.potential_function(*test_args, **self.kwargs)
+                if np.shape(values) != (len(self),):
+                    return False
+                one_at_a_time = [self.potential_function(*(arg[m] for arg in test_args), **self.kwargs) 
+                                 for m in range(len(self))]
+                if not np.allclose(values, one_at_a_time):
+                    return False
+                
+                gradients_one_at_a_time = np.stack([self.gradient.full_gradient(*(arg[m] for arg in test_args), **self.kwargs) 
+                                                    for m in range(len(self))], axis = 1)
+                if not np.allclose(self.batched_gradients(test_args), gradients_one_at_a_time):
+                    return False
+            return True
+        except (FloatingPointError, ZeroDivisionError, IndexError, ValueError) + derivatives.autodiff_errors:
+            return False
+    
+    
+    def gradient_array(self, qs_array):
+        '''the gradients of every potential wrt. its coordinates, as a (K * n_args, dim) array lined up with self.rows
+        
+        If the batched evaluation fails on shapes (a function wrongly 
+        declared vectorized, say) the set goes back to one potential at a time.'''
+        args = [qs_array[self.rows_array[:, k]] for k in range(self.rows_array.shape[1])]
+        if self.batched is None:
+            self.batched = self.takes_batches(args)
+        
+        if self.batched:
+            try:
+                gradients = self.batched_gradients(args)
+                return gradients.transpose(1, 0, 2).reshape(len(self.rows), qs_array.shape[-1])
+            except (ValueError, IndexError):
+                self.batched = False
+        
+        q_list = list(qs_array)
+        full_gradient = self.gradient.full_gradient
+        return np.concatenate([full_gradient(*[q_list[row] for row in rows], **self.kwargs) 
+                               for rows in self.rows_array.tolist()]).reshape(len(self.rows), qs_array.shape[-1])
+    
+    
+    def full_gradient(self, qs):
+        '''Potential.full_gradient for all the potentials, see gradient_array'''
+        return self.gradient_array(qs.array)
+    
+    
+    def batch_gradient(self, qs_array):
+        '''Potential.batch_gradient for the (M, N, dim) qs of M replicas, as a (K * n_args, M, dim) array lined up with self.rows'''
+        M, _, dim = qs_array.shape
+        if self.batched is None:
+            self.batched = self.takes_batches([qs_array[0, self.rows_array[:, k]] 
+                                               for k in range(self.rows_array.shape[1])])
+        
+        if self.batched:
+            args = [qs_array[:, self.rows_array[:, k]].reshape(-1, dim) for k in range(self.rows_array.shape[1])]
+            try:
+                gradients = self.batched_gradients(args)
+                n_args, K = self.rows_array.shape[1], len(self)
+                return gradients.reshape(n_args, M, K, dim).transpose(2, 0, 1, 3).reshape(K * n_args, M, dim)
+            except (ValueError, IndexError):
+                self.batched = False
+        
+        return np.concatenate([potential.batch_gradient(qs_array) for potential in self.potentials])
+    
+    
     
 class CellListsPairPotential:
-    def __init__(self, potential_function, **kwargs):
+    group = 'fast'
+    
+    def __init__(self, potential_function, gradient = None, vectorized = False, **kwargs):
         '''potential function is just a normal function of two variables.
         
-        Should be symmetric between the two variables.
+        Should be symmetric between the two variables. gradient is an optional 
+        analytic gradient, see derivatives.add_analytic_gradient.
+        
+        If vectorized is True, potential_function instead takes an (M, 2) 
+        array r of pair displacements q - p and returns the (M,) array of the 
+        potential of each pair (and an analytic gradient returns the (M, 2) 
+        array of its gradients wrt. r). Then all the pairs are done in a 
+        handful of array operations rather than one call per pair.
         
         **kwargs should hold any additional arguments passed to the potential.
         We might need to manage where they come from...'''
         
-        self.potential_function = derivatives.add_gradients(potential_function)
+        self.vectorized = vectorized
+        self.analytic_gradient = gradient
+        self.autodiff = derivatives.AutodiffSwitch(potential_function)
+        
+        if vectorized:
+            self.potential_function = potential_function
+        elif gradient is None:
+            self.potential_function = derivatives.add_gradients(potential_function)
+            self.gradient = self.potential_function.gradient
+        else:
+            self.potential_function = potential_function
+            self.gradient = [derivatives.get_gradient_i(potential_function, i, gradient) 
+                             for i in range(2)]
         self.kwargs = kwargs
-        self.gradient = self.potential_function.gradient
+        
+    
+    def pair_gradients(self, qs_array, i, j, periodic_box = None):
+        '''Returns the gradients wrt. q of the potential of each pair (q, p) = (qs_array[i], qs_array[j])
+        
+        i and j are arrays of row indices, and the result is an (M, 2) array.
+        The gradients wrt. p are minus these, by Newton's third law.
+        
+        In a periodic box (periodic_box = collisions.box_lengths(xlim, ylim)) 
+        p is the nearest periodic image of qs_array[j] to q.'''
+        qs, ps = qs_array[i], qs_array[j]
+        if periodic_box is not None:
+            ps = qs - collisions.minimum_image(qs - ps, periodic_box)
+        
+        if self.vectorized:
+            return derivatives.rowwise_gradient(self.potential_function, 
+                                                qs - ps,
+                                                self.analytic_gradient,
+                                                self.autodiff,
+                                                **self.kwargs)
+        
+        return np.array([self.gradient[0](q, p, **self.kwargs) 
+                         for q, p in zip(qs, ps)]).reshape(len(i), qs_array.shape[1])
+    
+    
+class InverseDistancePotential:
+    group = 'fast'
+    
+    def __init__(self, coefficient, charges, solver = 'barnes-hut', opening_angle = 0.5, softening = 0):
+        '''The long range potential coefficient * s_i * s_j / |q_i - q_j| of every pair of coordinates.
+        
+        charges holds the s_i for each coordinate (the masses, for gravity with 
+        coefficient = -G), in the order of Coordinates.coordinates. 
+        The forces come from barneshut.inverse_distance_solver_dict[solver]: 
+        the 'barnes-hut' quadtree, which is O(N log N) and as accurate as 
+        opening_angle makes it, or 'direct', every pair. softening > 0 smooths 
+        out 1/r at distances below softening, for close encounters.'''
+        try:
+            self.solver = barneshut.inverse_distance_solver_dict[solver]
+        except(KeyError):
+                raise KeyError(solver, 
+                               ' not found. The valid solver keys are ',
+                               barneshut.inverse_distance_solver_dict.keys())
+        
+        self.coefficient = coefficient
+        self.charges = np.asarray(charges, dtype = float)
+        self.opening_angle = opening_angle
+        self.softening = softening
         
         
-     
-    pass
+    def forces(self, qs_array):
+        '''the (N, 2) array of minus the gradient of the potential'''
+        return self.solver(qs_array, 
+                           self.charges, 
+                           self.coefficient, 
+                           self.opening_angle, 
+                           self.softening)
+    
+    
+class ParticleMeshPotential(InverseDistancePotential):
+    def __init__(self, coefficient, charges, xlim, ylim, N_grid = 64, periodic = False, softening = None):
+        '''The same potential as InverseDistancePotential, with the forces from a 
+        particle mesh over xlim x ylim instead, see particlemesh.ParticleMesh.'''
+        self.coefficient = coefficient
+        self.charges = np.asarray(charges, dtype = float)
+        self.mesh = particlemesh.ParticleMesh(xlim, ylim, N_grid, periodic, softening)
+        self.softening = self.mesh.softening
+        
+        
+    def forces(self, qs_array):
+        return self.mesh.forces(qs_array, self.charges, self.coefficient)
+    
     
 class Constraint:
-    def __init__(self, constraint_function, coordinates, **kwargs):
+    def __init__(self, constraint_function, coordinates, gradient = None, **kwargs):
         '''The args are strings that hold the name of each coordinate appearing in the input variables to the potential function.
         
+        gradient is an optional analytic gradient, see derivatives.add_analytic_gradient.
         
         **kwargs should hold any additional arguments passed to the potential.
         We might need to manage where they come from...'''
@@ -147,7 +500,7 @@ class Constraint:
         self.coordinates = coordinates
         self.kwargs = kwargs
         
-        self.gradient = Gradient(constraint_function, coordinates, **kwargs)
+        self.gradient = Gradient(constraint_function, coordinates, gradient, **kwargs)
         
         
         
@@ -14,26 +14,59 @@ and be responsible for computing/storing the forces
 import numpy as np
 import math
 import copy
+import os
+import json
+import collections
 
 import itertools
 
 
 class Coordinates: 
-    '''use this when initializing raw data or initializing a zero coordinate state'''
+    '''use this when initializing raw data or initializing a zero coordinate state
+    
+    The values are stored in a single contiguous (N, dim) float array, one row 
+    per coordinate. index[name] gives the row of the coordinate called name, so 
+    qs['earth'] still works (and returns a view into the row, so writing into 
+    it writes into the coordinates). The arithmetic +, - and scalar * act on 
+    the whole array at once.
+    '''
     coordinates = list()
+    index = dict()
     dim = 2
-    '''this should be set up by the dynamical system as a class variable'''
+    '''this should be set up by the dynamical system as a class variable, 
+    using Coordinates.set_coordinates(coordinates)'''
+    
+    __array_ufunc__ = None
+    '''tells numpy to leave np.float64 * Coordinates to our __rmul__'''
     
     def __init__(self, coord_dict = None):
         if coord_dict is None:
-            self.coord_dict = {i:np.zeros(self.dim, dtype = float) for i in self.coordinates}
+            self.array = np.zeros((len(self.coordinates), self.dim), dtype = float)
+        elif isinstance(coord_dict, Coordinates):
+            self.array = np.array(coord_dict.array, dtype = float)
         else:
-            self.coord_dict = {i:np.array(q, dtype = float) for i, q in coord_dict.items()}
-
-
-    # def NewCoordinates(self, coord_dict):
-    #     '''for optimization, use this method and make the qs and q_dots the correct data structure yourself'''
-    #     self.coord_dict = coord_dict
+            self.array = np.array([coord_dict[i] for i in self.coordinates], dtype = float)\
+                .reshape((len(self.coordinates), self.dim))
+    
+    
+    @classmethod
+    def set_coordinates(cls, coordinates):
+        '''fixes the coordinate names, and so the row of each name in the array'''
+        cls.coordinates = coordinates
+        cls.index = {i:row for row, i in enumerate(coordinates)}
+    
+    
+    @classmethod
+    def from_array(cls, array):
+        '''for optimization, wraps an (N, dim) array without copying it'''
+        coords = cls.__new__(cls)
+        coords.array = array
+        return coords
+    
+    
+    @property
+    def coord_dict(self):
+        return {i:self.array[row] for i, row in self.index.items()}
         
     
     def __str__(self):
@@ -41,10 +74,7 @@ class Coordinates:
     
     
     def copy(self):
-        coord_dict_copy = copy.deepcopy(self.coord_dict)
-        coordinates_copy = Coordinates(coord_dict_copy)
-        
-        return coordinates_copy
+        return Coordinates.from_array(self.array.copy())
         
     
     
@@ -53,33 +83,27 @@ class Coordinates:
     
     
     def __iter__(self):
-        return self.coord_dict.__iter__()
+        return iter(self.coordinates)
         
     def __getitem__(self, i):
-        return self.coord_dict[i]
+        return self.array[self.index[i]]
     
     
     def __setitem__(self, i, value):
-        self.coord_dict[i] = value
+        self.array[self.index[i]] = value
 
 
     def __add__(self, other):
-        coord_sum = Coordinates(self.coord_dict)
-        for i in self.coordinates:
-            coord_sum.coord_dict[i] += other[i]
-        return coord_sum
+        return Coordinates.from_array(self.array + other.array)
     
     def __sub__(self, other):
-        coord_sum = Coordinates(self.coord_dict)
-        for i in self.coordinates:
-            coord_sum.coord_dict[i] -= other[i]
-        return coord_sum
+        return Coordinates.from_array(self.array - other.array)
 
+    def __mul__(self, scalar):
+        return Coordinates.from_array(scalar * self.array)
+    
     def __rmul__(self, scalar):
-        coord_sum = Coordinates(self.coord_dict)
-        for i in self.coordinates:
-            coord_sum.coord_dict[i] *= scalar
-        return coord_sum
+        return Coordinates.from_array(scalar * self.array)
 
 
 class State:
@@ -120,6 +144,15 @@ class State:
     #     return self
     
     
+    @classmethod
+    def from_arrays(cls, qs_array, q_dots_array):
+        '''for optimization, wraps (N, dim) arrays as a State without copying them'''
+        state = cls.__new__(cls)
+        state.qs = Coordinates.from_array(qs_array)
+        state.q_dots = Coordinates.from_array(q_dots_array)
+        return state
+    
+    
     @property
     def masses(self):
         return self.dynamical_system.masses
@@ -133,9 +166,14 @@ class State:
         
     
     
-    def get_forces(self):
+    def get_forces(self, groups = None):
+        '''The forces of the potentials in groups (see potentials.potential_groups), or of all of them'''
         state = self
         dynamical_system = self.dynamical_system 
+        dynamical_system.N_force_evaluations += 1
+        
+        if state.qs.array.ndim == 3:
+            return self.get_ensemble_forces(groups)
         
         
         forces = Coordinates()
@@ -143,21 +181,35 @@ class State:
         
         
         '''Compute the force generated by the potentials'''
-        for _, potential in dynamical_system.potentials.items():
-            for i in potential.coordinates:
-                force = - potential.gradient[i](state.qs)
-                forces[i] += force
-        
-        if dynamical_system.cell_list_potentials:
+        for potential_set in dynamical_system.potential_sets:
+            if groups is not None and potential_set.group not in groups:
+                continue
+            np.subtract.at(forces.array, potential_set.rows, potential_set.full_gradient(state.qs))
+        
+        if dynamical_system.parallel_forces is not None:
+            '''Compute the forces generated by cell-list potentials in the worker processes'''
+            forces.array += dynamical_system.parallel_forces.forces(state.qs.array, 
+                                                                    dynamical_system.forward_neighbor_pairs,
+                                                                    groups)
+        
+        elif dynamical_system.cell_list_potentials:
             '''Compute the forces generated by cell-list potentials next'''
-            forward_neighbor_lists = dynamical_system.forward_neighbor_lists
-            for q in state.qs:
-                for p in forward_neighbor_lists[q]:
-                    for potential in dynamical_system.cell_list_potentials.values():
-                        force = - potential.gradient[0](state.qs[q], state.qs[p])
-                        #need to define a cell_list_pair_potential object...
-                        forces[q] += force
-                        forces[p] -= force
+            i, j = dynamical_system.forward_neighbor_pairs
+            N = len(forces.array)
+            for potential in dynamical_system.cell_list_potentials.values():
+                if groups is not None and potential.group not in groups:
+                    continue
+                gradients = potential.pair_gradients(state.qs.array, i, j, 
+                                                     dynamical_system.periodic_box)
+                '''the force on q_i is -gradient and the force on q_j is +gradient'''
+                for k in range(Coordinates.dim):
+                    forces.array[:, k] += np.bincount(j, gradients[:, k], minlength = N) \
+                                        - np.bincount(i, gradients[:, k], minlength = N)
+        
+        for potential in dynamical_system.inverse_distance_potentials.values():
+            if groups is not None and potential.group not in groups:
+                continue
+            forces.array += potential.forces(state.qs.array)
         
         '''Compute the force generated by the constraints'''
         
@@ -216,11 +268,51 @@ class State:
                 
         return forces
             
-    def get_acceleration(self):
-        forces = self.get_forces()
-        masses = self.masses
-        accel_qs = Coordinates(
-            {i:masses[i]**-1 * forces[i] for i in forces.coordinates}
+    def get_ensemble_forces(self, groups = None):
+        '''get_forces for the state of an ensemble of M replicas, whose qs are an (M, N, dim) array
+        
+        Each potential set is evaluated on all the replicas at once (see 
+        potentials.PotentialSet.batch_gradient), and the cell-list potentials on 
+        the neighbor pairs of all the replicas together, numbering the rows 
+        of replica m from m * N. Constraints aren't supported.'''
+        state = self
+        dynamical_system = self.dynamical_system 
+        qs_array = state.qs.array
+        M, N, dim = qs_array.shape
+        
+        forces = np.zeros_like(qs_array)
+        
+        def in_groups(potential):
+            return groups is None or potential.group in groups
+        
+        for potential_set in dynamical_system.potential_sets:
+            if in_groups(potential_set):
+                for row, gradient in zip(potential_set.rows, potential_set.batch_gradient(qs_array)):
+                    forces[:, row] -= gradient
+        
+        if dynamical_system.cell_list_potentials:
+            i, j = dynamical_system.forward_neighbor_pairs
+            flat_qs, flat_forces = qs_array.reshape(M * N, dim), forces.reshape(M * N, dim)
+            for potential in dynamical_system.cell_list_potentials.values():
+                if in_groups(potential):
+                    gradients = potential.pair_gradients(flat_qs, i, j, dynamical_system.periodic_box)
+                    for k in range(dim):
+                        flat_forces[:, k] += np.bincount(j, gradients[:, k], minlength = M * N) \
+                                           - np.bincount(i, gradients[:, k], minlength = M * N)
+        
+        for potential in dynamical_system.inverse_distance_potentials.values():
+            if in_groups(potential):
+                for m in range(M):
+                    forces[m] += potential.forces(qs_array[m])
+        
+        return Coordinates.from_array(forces)
+    
+    
+    def get_acceleration(self, groups = None):
+        forces = self.get_forces(groups)
+        mass_array = self.dynamical_system.mass_array
+        accel_qs = Coordinates.from_array(
+            forces.array / mass_array[:, np.newaxis]
             )
         return accel_qs
 
@@ -236,14 +328,20 @@ class TrajectoryData:
     It should have methods for getting the various data used in rendering.
     needed 
     '''
-    def __init__(self, dynamical_system):
+    def __init__(self, dynamical_system, N_time_steps = None):
+        '''N_time_steps is the expected number of states. The list doesn't need it'''
         self.dynamical_system = dynamical_system
         self.states = [dynamical_system.initial_state]
         
-        self.dt = dynamical_system.dt
+        self.set_frame_rate(dynamical_system.record_dt)
+    
+    
+    def set_frame_rate(self, dt, frame_rate = 1/20):
+        '''dt is the time between stored states, frame_rate the time between rendered frames'''
+        self.dt = dt
         
         
-        self.FRAME_RATE = 1/20
+        self.FRAME_RATE = frame_rate
         self.skipframes = math.ceil(self.FRAME_RATE / self.dt)
         self.frame_dt = self.dt * self.skipframes
     
@@ -255,10 +353,21 @@ class TrajectoryData:
     def __getitem__(self, i):
         return self.states[i]
     
+    
+    def __len__(self):
+        return len(self.states)
+    
+    
+    def flush(self):
+        '''called by run_dynamics once the last state is appended. 
+        
+        Nothing to do here since the states are all in memory'''
+        pass
+    
     def process_data_for_rendering(self):
         '''Run this before heading to the renderer to assemble data ahead of time'''
         
-        self.N_time_steps = len(self.states)
+        self.N_time_steps = len(self)
         self.N_frames = len(list(range(0, self.N_time_steps, self.skipframes)))
         N_frames = self.N_frames
         
@@ -273,8 +382,8 @@ class TrajectoryData:
             vertices_at_time.append([]) # adding t'th component to thislist of lists
             for i in self.dynamical_system.rendered_paths:
                 vertices_at_time[time_step].append(\
-                                           (self.states[t].qs[i][0],
-                                            self.states[t].qs[i][1])
+                                           (self[t].qs[i][0],
+                                            self[t].qs[i][1])
                                            )
                 
         self.vertices_at_time = vertices_at_time
@@ -294,7 +403,186 @@ class TrajectoryData:
         return self.ys_at_time[time]
    
     def get_x(self, i, t):
-        return self.states[t].qs[i][0]
+        return self[t].qs[i][0]
     
     def get_y(self, i, t):
-        return self.states[t].qs[i][1]
\ No newline at end of file
+        return self[t].qs[i][1]
+
+
+class ArrayTrajectoryData(TrajectoryData):
+    '''TrajectoryData that stores the states in preallocated (T, N, dim) arrays
+    
+    Instead of a list of State objects, the qs and q_dots of time step t are 
+    rows qs[t] and q_dots[t] of two contiguous arrays. The arrays are sized 
+    ahead of time from N_time_steps and doubled whenever they fill up, so 
+    append is just a copy into the next row. trajectory_data[t] still returns
+    a State, whose Coordinates are views into the arrays.
+    '''
+    def __init__(self, dynamical_system, N_time_steps = 1, initial_state = None):
+        '''initial_state defaults to the one of the dynamical system'''
+        self.N_states = 0
+        
+        shape = (max(N_time_steps, 1), len(Coordinates.coordinates), Coordinates.dim)
+        self._qs = self._allocate('qs', shape)
+        self._q_dots = self._allocate('q_dots', shape)
+        
+        self.dynamical_system = dynamical_system
+        self.append(dynamical_system.initial_state if initial_state is None else initial_state)
+        
+        self.set_frame_rate(dynamical_system.record_dt)
+    
+    
+    @property
+    def qs(self):
+        '''the (T, N, dim) array of qs recorded so far'''
+        return self._qs[:self.N_states]
+    
+    
+    @property
+    def q_dots(self):
+        '''the (T, N, dim) array of q_dots recorded so far'''
+        return self._q_dots[:self.N_states]
+    
+    
+    @property
+    def states(self):
+        return [self[t] for t in range(self.N_states)]
+    
+    
+    def _allocate(self, name, shape):
+        '''returns an empty array of the given shape to hold the qs or the q_dots'''
+        return np.empty(shape, dtype = float)
+    
+    
+    def _grow(self):
+        '''doubles the capacity of the arrays, keeping the recorded states'''
+        capacity = 2 * len(self._qs)
+        for name in ('qs', 'q_dots'):
+            old = getattr(self, '_' + name)
+            new = self._allocate(name, (capacity,) + old.shape[1:])
+            new[:self.N_states] = old[:self.N_states]
+            setattr(self, '_' + name, new)
+    
+    
+    def append(self, value):
+        if self.N_states == len(self._qs):
+            self._grow()
+        self._qs[self.N_states] = value.qs.array
+        self._q_dots[self.N_states] = value.q_dots.array
+        self.N_states += 1
+    
+    
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.N_states
+        if not 0 <= i < self.N_states:
+            raise IndexError('trajectory index out of range')
+        return State.from_arrays(self._qs[i], self._q_dots[i])
+    
+    
+    def __len__(self):
+        return self.N_states
+    
+    
+    def process_data_for_rendering(self):
+        '''Same as TrajectoryData.process_data_for_rendering, but as one array slice'''
+        self.N_time_steps = len(self)
+        self.N_frames = len(range(0, self.N_time_steps, self.skipframes))
+        
+        rows = [Coordinates.index[i] for i in self.dynamical_system.rendered_paths]
+        self.vertices_at_time = self.qs[::self.skipframes][:, rows, :2]
+
+
+
+
+class MemmapTrajectoryData(ArrayTrajectoryData):
+    '''ArrayTrajectoryData whose arrays are memory-mapped .npy files on disk
+    
+    The states are streamed into path/qs.npy and path/q_dots.npy as they are 
+    appended, and path/trajectory.json records how many of the rows are 
+    filled in (and the dt between them) whenever flush is called. Only the 
+    last few states are held in memory, so looking back at them (as the 
+    dynamics loop does) doesn't read from the mapped files.
+    
+    Use MemmapTrajectoryData.open (or DynamicalSystem.load_trajectory) to read
+    a finished trajectory back later. The files are opened with 
+    mmap_mode='r', so qs, q_dots and trajectory_data[t] are zero-copy.
+    '''
+    history = 2
+    
+    def __init__(self, dynamical_system, N_time_steps = 1, path = None):
+        self.path = path or dynamical_system.trajectory_path
+        os.makedirs(self.path, exist_ok = True)
+        self.recent_states = collections.deque(maxlen = self.history)
+        
+        super().__init__(dynamical_system, N_time_steps)
+    
+    
+    @classmethod
+    def open(cls, dynamical_system, path = None):
+        '''opens a trajectory written by an earlier run for reading'''
+        trajectory_data = cls.__new__(cls)
+        trajectory_data.path = path or dynamical_system.trajectory_path
+        trajectory_data.recent_states = collections.deque(maxlen = cls.history)
+        
+        with open(os.path.join(trajectory_data.path, 'trajectory.json')) as file:
+            metadata = json.load(file)
+        
+        trajectory_data._qs = np.load(os.path.join(trajectory_data.path, 'qs.npy'), 
+                                      mmap_mode = 'r')
+        trajectory_data._q_dots = np.load(os.path.join(trajectory_data.path, 'q_dots.npy'), 
+                                          mmap_mode = 'r')
+        if trajectory_data._qs.shape[1:] != (len(Coordinates.coordinates), Coordinates.dim):
+            raise ValueError(trajectory_data.path, 
+                             ' does not hold the coordinates of this dynamical system')
+        
+        trajectory_data.N_states = metadata['N_states']
+        trajectory_data.dynamical_system = dynamical_system
+        trajectory_data.set_frame_rate(metadata['dt'])
+        return trajectory_data
+    
+    
+    def _allocate(self, name, shape):
+        '''creates path/name.npy to hold the array.
+        
+        When growing, the new file is written next to the old one and moved 
+        into place, while the old memmap still reads from the replaced file.'''
+        file_name = os.path.join(self.path, name + '.npy')
+        temporary_file_name = file_name + '.tmp'
+        
+        array = np.lib.format.open_memmap(temporary_file_name, 
+                                          mode = 'w+', 
+                                          dtype = float, 
+                                          shape = shape)
+        os.replace(temporary_file_name, file_name)
+        return array
+    
+    
+    def append(self, value):
+        super().append(value)
+        self.recent_states.append(value)
+    
+    
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.N_states
+        first_recent = self.N_states - len(self.recent_states)
+        if first_recent <= i < self.N_states:
+            return self.recent_states[i - first_recent]
+        return super().__getitem__(i)
+    
+    
+    def flush(self):
+        '''writes the filled rows to disk and records how many there are'''
+        self._qs.flush()
+        self._q_dots.flush()
+        
+        with open(os.path.join(self.path, 'trajectory.json'), 'w') as file:
+            json.dump({'N_states': self.N_states, 'dt': self.dt}, file)
+
+
+
+trajectory_storage_dict = {'list': TrajectoryData,
+                           'array': ArrayTrajectoryData,
+                           'memmap': MemmapTrajectoryData
+                           }
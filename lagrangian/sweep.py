@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps: run the same dynamical system for every combination of
+some parameters, on all the cores, and collect the results in one table.
+
+basic usage:
+
+def make_springs(dt, integrator_code, spring_constant):
+    dynamical_system = DynamicalSystem(qs_init, dt = dt, integrator_code = integrator_code)
+    dynamical_system.add_potential(spring, ['q1', 'q2'], spring_constant = spring_constant)
+    return dynamical_system
+
+def final_energy(dynamical_system):
+    ...
+
+grid = sweep.parameter_grid(dt = [1/60, 1/120],
+                            integrator_code = ['ssprk3', 'yoshida4'],
+                            spring_constant = [1, 10, 100])
+results = sweep.run_sweep(make_springs, grid, total_time = 10,
+                          observables = {'final energy': final_energy})
+
+The factory and the observables are sent to worker processes, so they have to
+be functions defined at the top level of a module (not lambdas). The runs are
+headless, nothing is displayed. Runs using the 'memmap' trajectory storage
+need a trajectory_path of their own.
+"""
+
+import itertools
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+
+def parameter_grid(**parameter_values):
+    '''All the combinations of the parameter values, as a list of dicts of parameters
+
+    parameter_grid(dt = [1/60, 1/120], wall_elasticity = [1, .5]) has 4 dicts,
+    {'dt': 1/60, 'wall_elasticity': 1}, {'dt': 1/60, 'wall_elasticity': .5}, ...
+    '''
+    names = list(parameter_values.keys())
+    return [dict(zip(names, values))
+            for values in itertools.product(*parameter_values.values())]
+
+
+def _headless():
+    '''runs in each worker process before its jobs'''
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def run_job(factory, parameters, total_time, observables = None, keep_trajectories = False):
+    '''Builds the dynamical system factory(**parameters), runs it and returns its row of the results
+
+    The row holds the parameters, the value of each observable
+    (observables[name](dynamical_system), after the run), the run time, the
+    force evaluations per step, and if keep_trajectories the (T, N, dim)
+    arrays 'qs' and 'q_dots' of the trajectory. If the run fails (say the
+    forces blow up) the row holds the 'error' instead of the results.
+    '''
+    row = dict(parameters)
+    start = time.time()
+    try:
+        dynamical_system = factory(**parameters)
+        dynamical_system.run_dynamics(total_time, progress = False)
+
+        for name, observable in (observables or {}).items():
+            row[name] = observable(dynamical_system)
+
+        if keep_trajectories:
+            trajectory_data = dynamical_system.trajectory_data
+            row['qs'] = np.array([state.qs.array for state in trajectory_data.states])
+            row['q_dots'] = np.array([state.q_dots.array for state in trajectory_data.states])
+
+        row['force evaluations per step'] = dynamical_system.force_evaluations_per_step
+        row['error'] = None
+    except Exception:
+        row['error'] = traceback.format_exc()
+
+    row['elapsed'] = time.time() - start
+    return row
+
+
+def run_sweep(factory, grid, total_time, observables = None, keep_trajectories = False, max_workers = None):
+    '''Runs run_job for every dict of parameters in grid across a process pool
+
+    Returns the result table, a list with the row of each job in the order of
+    grid. max_workers defaults to the number of cores.
+    '''
+    with ProcessPoolExecutor(max_workers = max_workers, initializer = _headless) as executor:
+        jobs = [executor.submit(run_job, factory, parameters, total_time, observables, keep_trajectories)
+                for parameters in grid]
+        return [job.result() for job in jobs]
+
+
+def table_column(results, name):
+    '''the column name of the result table, as an array (None for failed jobs)'''
+    return np.array([row.get(name) for row in results])
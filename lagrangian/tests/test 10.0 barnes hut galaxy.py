@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Barnes-Hut: a disk galaxy of 1000 stars
+
+The gravity of every pair of stars is one inverse distance potential, which
+the quadtree sums in O(N log N).
+"""
+import numpy as np
+import math
+
+import lagrangian as lagrangian
+from lagrangian.dynamicalsystem import DynamicalSystem
+
+
+N = 1000
+
+G = 1
+softening = .2
+
+dt = 2**-6
+
+rng = np.random.default_rng(0)
+
+
+radii = 8 * np.sqrt(rng.uniform(.02, 1, N))
+angles = rng.uniform(0, 2 * math.pi, N)
+
+qs_init = dict()
+q_dots_init = dict()
+
+for i in range(N):
+    name = 'star' + str(i)
+    direction = np.array([math.cos(angles[i]), math.sin(angles[i])])
+    
+    enclosed_mass = N * (radii[i] / 8)**2
+    speed = math.sqrt(G * enclosed_mass / radii[i])
+    
+    qs_init[name] = radii[i] * direction
+    q_dots_init[name] = speed * np.array([-direction[1], direction[0]])
+
+
+
+
+dynamical_system = DynamicalSystem(qs_init, 
+                                   q_dots_init,
+                                   xlim = [-20,20],
+                                   ylim = [-20, 20],
+                                   dt=dt,
+                                   record_dt = 1/20,
+                                   integrator_code = 'verlet')
+
+for q in list(dynamical_system.initial_state.qs)[::50]:
+    dynamical_system.add_rendered_path([q] )
+
+
+dynamical_system.add_inverse_distance_potential(-G, softening = softening)
+
+
+
+time = 2
+
+dynamical_system.run_dynamics(time)
+
+
+dynamical_system.display()
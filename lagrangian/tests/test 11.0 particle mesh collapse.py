@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Particle mesh: a cold square of 3000 particles collapsing under gravity
+
+The softened gravity of all the pairs comes from the FFT of the charges on 
+a 128 x 128 grid.
+"""
+import numpy as np
+
+import lagrangian as lagrangian
+from lagrangian.dynamicalsystem import DynamicalSystem
+
+
+N = 3000
+
+G = .05
+softening = .5
+
+dt = 2**-6
+
+rng = np.random.default_rng(1)
+
+
+positions = rng.uniform(-8, 8, (N, 2))
+
+qs_init = {'particle' + str(i): positions[i] for i in range(N)}
+q_dots_init = {i: np.zeros(2) for i in qs_init.keys()}
+
+
+
+
+dynamical_system = DynamicalSystem(qs_init, 
+                                   q_dots_init,
+                                   xlim = [-10,10],
+                                   ylim = [-10, 10],
+                                   wall_elasticity = .8,
+                                   dt=dt,
+                                   record_dt = 1/20,
+                                   integrator_code = 'verlet')
+
+for q in list(dynamical_system.initial_state.qs)[::30]:
+    dynamical_system.add_rendered_path([q] )
+
+
+dynamical_system.add_particle_mesh_potential(-G, N_grid = 128, softening = softening)
+
+
+
+time = 3
+
+dynamical_system.run_dynamics(time)
+
+
+dynamical_system.display()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dormand-Prince: a comet on an eccentric orbit
+
+The adaptive steps shrink for the close pass by the sun and grow again 
+further out, with the recorded frames still every record_dt.
+"""
+import numpy as np
+
+import lagrangian as lagrangian
+from lagrangian.dynamicalsystem import DynamicalSystem
+
+
+G = 1
+
+qs_init = {
+    'sun': [0,0],
+    'comet': [8, 0]
+    }
+
+masses = {
+    'sun': 1000,
+    'comet': 1
+    }
+
+q_dots_init = {
+    'sun': [0,0],
+    'comet': [0, 4]
+    }
+
+
+
+
+dynamical_system = DynamicalSystem(qs_init, 
+                                   q_dots_init,
+                                   masses = masses,
+                                   xlim = [-10,10],
+                                   ylim = [-10, 10],
+                                   dt=2**-6,
+                                   record_dt = 1/16,
+                                   tolerance = 1e-8,
+                                   integrator_code = 'dormand-prince')
+
+for i in qs_init.keys():
+    dynamical_system.add_rendered_path([i] )
+
+
+dynamical_system.add_inverse_distance_potential(-G, solver = 'direct')
+
+
+
+time = 4
+
+dynamical_system.run_dynamics(time)
+
+print(f"{dynamical_system.N_steps_taken} steps, {dynamical_system.N_rejected_steps} rejected")
+
+
+dynamical_system.display()
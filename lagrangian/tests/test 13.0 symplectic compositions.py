@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Symplectic compositions: an anharmonic oscillator with yoshida4
+
+The fourth order composition of velocity verlet steps keeps the energy of
+the orbit bounded, at a large dt.
+"""
+import numpy as np
+
+import lagrangian as lagrangian
+from lagrangian.dynamicalsystem import DynamicalSystem
+
+
+qs_init = {'q': [1, 0]}
+
+q_dots_init = {'q': [0, 1]}
+
+
+
+def anharmonic(q, *, k=1, c=.1):
+    r2 = np.dot(q, q)
+    return k / 2 * r2 + c * r2**2
+
+
+def anharmonic_gradient(q, *, k=1, c=.1):
+    '''closed form gradient, so it needn't be differentiated'''
+    return [(k + 4 * c * np.dot(q, q)) * q]
+
+
+
+
+dynamical_system = DynamicalSystem(qs_init, 
+                                   q_dots_init,
+                                   xlim = [-5,5],
+                                   ylim = [-5, 5],
+                                   dt=2**-3,
+                                   integrator_code = 'yoshida4')
+
+dynamical_system.add_rendered_path(['q'])
+
+
+dynamical_system.add_potential(anharmonic, ['q'], gradient = anharmonic_gradient)
+
+
+
+time = 20
+
+dynamical_system.run_dynamics(time)
+
+
+dynamical_system.display()
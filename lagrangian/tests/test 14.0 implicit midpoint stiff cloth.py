@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Implicit midpoint: a cloth of stiff springs
+
+The springs are too stiff for velocity verlet at dt = 1/20, which blows up,
+while the implicit midpoint rule stays stable at that dt.
+"""
+import numpy as np
+import math
+from itertools import product
+
+import lagrangian as lagrangian
+from lagrangian.dynamicalsystem import DynamicalSystem
+
+
+N_side = 8
+spacing = .5
+spring_constant = 2000
+
+
+qs_init = dict()
+for a, b in product(range(N_side), range(N_side)):
+    qs_init[str(a)+'_'+str(b)] = np.array([a * spacing - 2, b * spacing - 2])
+
+q_dots_init = {i: np.zeros(2) for i in qs_init.keys()}
+q_dots_init['0_0'] = np.array([4, 2])
+
+
+
+def spring(q, p, *, k=spring_constant, rest_length=spacing):
+    return k / 2 * (np.linalg.norm(q - p) - rest_length)**2
+
+
+def spring_gradient(q, p, *, k=spring_constant, rest_length=spacing):
+    '''closed form gradient, so it needn't be differentiated'''
+    r = q - p
+    d = np.linalg.norm(r)
+    gradient_q = k * (d - rest_length) * r / d
+    return [gradient_q, - gradient_q]
+
+
+
+
+dynamical_system = DynamicalSystem(qs_init, 
+                                   q_dots_init,
+                                   xlim = [-10,10],
+                                   ylim = [-10, 10],
+                                   dt=1/20,
+                                   integrator_code = 'implicit midpoint')
+
+for a, b in product(range(N_side), range(N_side)):
+    for da, db in [(1, 0), (0, 1), (1, 1)]:
+        if a + da < N_side and b + db < N_side:
+            i, j = str(a)+'_'+str(b), str(a + da)+'_'+str(b + db)
+            dynamical_system.add_potential(spring, [i, j], 
+                                           gradient = spring_gradient, 
+                                           rest_length = spacing * math.hypot(da, db))
+            dynamical_system.add_rendered_path([i, j])
+
+
+
+time = 4
+
+dynamical_system.run_dynamics(time)
+
+
+dynamical_system.display()
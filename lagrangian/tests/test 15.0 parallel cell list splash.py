@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cell lists fluid molecules splash, with the pair forces on 4 processes
+
+"""
+import numpy as np
+from itertools import product
+
+import lagrangian as lagrangian
+from lagrangian.dynamicalsystem import DynamicalSystem
+
+
+N_rows = 76
+N_columns = 40
+
+r = 1
+
+offset = np.array([-39.8,-39.1])
+
+dt = 2**-9
+
+g = 9.8
+
+interatomic_distance = 1
+cell_list_distance = 2
+
+
+
+qs_init = dict()
+
+for i,j in product(range(N_rows), range(N_columns)):
+    qs_init[str(i)+'_'+str(j)] = np.array([r*i, r*j]) + offset
+
+
+q_dots_init = {i:np.array([0,0]) for i in qs_init.keys()}
+
+
+
+def van_der_waals(r, *, rest_distance=interatomic_distance):
+    '''vectorized: r is the (M, 2) array of displacements between the M pairs'''
+    d = np.linalg.norm(r, axis=1)
+    eps = rest_distance
+    return eps*((d/eps)**-12 - 2 * (d/eps)**-6)
+
+
+def gravity(*qs):
+    return sum(g * q[1] for q in qs)
+
+
+def gravity_gradient(*qs):
+    '''closed form gradient, so it needn't be differentiated'''
+    return [np.array([0, g]) for q in qs]
+
+
+
+
+dynamical_system = DynamicalSystem(qs_init, 
+                                   q_dots_init,
+                                   xlim = [-40,40],
+                                   ylim = [-40, 40],
+                                   cell_list_dx = cell_list_distance,
+                                   cell_list_dy = cell_list_distance,
+                                   cell_list_workers = 4,
+                                   wall_elasticity = .6,
+                                   dt=dt,
+                                   record_dt = 1/20,
+                                   integrator_code = 'semi-implicit euler')
+
+for q in list(dynamical_system.initial_state.qs)[::40]:
+    dynamical_system.add_rendered_path([q] )
+
+
+dynamical_system.add_cell_list_pair_potential(van_der_waals, vectorized = True)
+dynamical_system.add_potential(gravity, [name for name in qs_init.keys()], gradient = gravity_gradient)
+
+
+
+time = 1
+
+dynamical_system.run_dynamics(time)
+
+
+dynamical_system.display()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compiled phase space: chains of molecules toppling over in a box
+
+compile() turns the dynamical system into flat arrays once, and its 
+run_dynamics steps those.
+"""
+import numpy as np
+from itertools import product
+
+import lagrangian as lagrangian
+from lagrangian.dynamicalsystem import DynamicalSystem
+
+
+N_chains = 12
+chain_length = 10
+
+spacing = 1.1
+
+dt = 2**-8
+
+g = 9.8
+
+rng = np.random.default_rng(3)
+
+
+
+qs_init = dict()
+q_dots_init = dict()
+
+for i, j in product(range(N_chains), range(chain_length)):
+    qs_init[str(i)+'_'+str(j)] = np.array([-15 + 2.5 * i, -18 + spacing * j])
+    q_dots_init[str(i)+'_'+str(j)] = rng.normal(0, 1, 2)
+
+
+
+def spring(q, p, *, k=50, rest_length=spacing):
+    return k / 2 * (np.linalg.norm(q - p) - rest_length)**2
+
+
+def spring_gradient(q, p, *, k=50, rest_length=spacing):
+    '''closed form gradient, so it needn't be differentiated'''
+    r = q - p
+    d = np.linalg.norm(r)
+    gradient_q = k * (d - rest_length) * r / d
+    return [gradient_q, - gradient_q]
+
+
+def gravity(*qs):
+    return sum(g * q[1] for q in qs)
+
+
+def gravity_gradient(*qs):
+    '''closed form gradient, so it needn't be differentiated'''
+    return [np.array([0, g]) for q in qs]
+
+
+def van_der_waals(r, *, rest_distance=1.1):
+    '''vectorized: r is the (M, 2) array of displacements between the M pairs'''
+    d = np.linalg.norm(r, axis=1)
+    eps = rest_distance
+    return eps*((d/eps)**-12 - 2 * (d/eps)**-6)
+
+
+
+
+dynamical_system = DynamicalSystem(qs_init, 
+                                   q_dots_init,
+                                   xlim = [-20,20],
+                                   ylim = [-20, 20],
+                                   cell_list_dx = 2.5,
+                                   cell_list_dy = 2.5,
+                                   wall_elasticity = .8,
+                                   dt=dt,
+                                   record_dt = 1/20,
+                                   integrator_code = 'velocity verlet')
+
+for i, j in product(range(N_chains), range(chain_length - 1)):
+    dynamical_system.add_potential(spring, 
+                                   [str(i)+'_'+str(j), str(i)+'_'+str(j + 1)], 
+                                   gradient = spring_gradient)
+    dynamical_system.add_rendered_path([str(i)+'_'+str(j), str(i)+'_'+str(j + 1)])
+
+dynamical_system.add_potential(gravity, [name for name in qs_init.keys()], gradient = gravity_gradient)
+dynamical_system.add_cell_list_pair_potential(van_der_waals, vectorized = True)
+
+
+
+phase_space = dynamical_system.compile()
+
+time = 4
+
+phase_space.run_dynamics(time)
+
+
+dynamical_system.display()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Potential sets: a cluster of atoms with a potential for every pair
+
+The 780 pair potentials of the 40 atoms are added one by one, and merge 
+into one potential set whose gradients come from a single batched 
+evaluation, since van_der_waals works on arrays of pairs.
+"""
+import numpy as np
+import math
+import itertools
+
+import lagrangian as lagrangian
+from lagrangian.dynamicalsystem import DynamicalSystem
+
+
+N = 40
+
+dt = 2**-9
+
+golden_angle = 2 * math.pi / ((1 + 5**.5) / 2)
+
+
+qs_init = dict()
+for n in range(N):
+    qs_init[str(n)] = .9 * math.sqrt(n) * np.array([math.cos(n * golden_angle), math.sin(n * golden_angle)])
+
+
+
+def van_der_waals(q, p, *, rest_distance=1):
+    '''works on single pairs and, with axis=-1, on batches of them'''
+    d = np.linalg.norm(q - p, axis=-1)
+    eps = rest_distance
+    return eps*((d/eps)**-12 - 2 * (d/eps)**-6)
+
+
+
+
+dynamical_system = DynamicalSystem(qs_init, 
+                                   xlim = [-10,10],
+                                   ylim = [-10, 10],
+                                   dt=dt,
+                                   record_dt = 1/20,
+                                   integrator_code = 'ssprk3')
+
+for q in qs_init.keys():
+    dynamical_system.add_rendered_path([q] )
+
+
+for i, j in itertools.combinations(qs_init.keys(), 2):
+    dynamical_system.add_potential(van_der_waals, [i, j], rest_distance = 1)
+
+
+
+time = 2
+
+dynamical_system.run_dynamics(time)
+
+
+dynamical_system.display()
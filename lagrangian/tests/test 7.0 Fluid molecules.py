@@ -84,6 +84,7 @@ dynamical_system = DynamicalSystem(qs_init,
                                    ylim = [-5, 5],
                                    wall_elasticity = 1,
                                    dt=dt,
+                                   record_dt = 1/20,
                                    integrator_code = 'verlet') #must have initial state to define the coordinates
 
 for i in range(N):
@@ -67,6 +67,15 @@ def gravity(q, p, mass1, mass2, G=G):
     
     
     return - mass1 * mass2 * G / d
+
+
+def gravity_gradient(q, p, mass1, mass2, G=G):
+    '''closed form gradient of gravity wrt. q and p, so it needn't be differentiated'''
+    r = q - p
+    d = np.linalg.norm(r)
+    
+    gradient_q = mass1 * mass2 * G * r / d**3
+    return [gradient_q, - gradient_q]
         
 
 
@@ -90,6 +99,7 @@ for i in qs_init.keys():
 for i, j in itertools.combinations(qs_init.keys(), 2):
     dynamical_system.add_potential(gravity,
                                 [i, j], 
+                                gradient = gravity_gradient,
                                 mass1 = masses[i],
                                 mass2 = masses[j]
                                 )
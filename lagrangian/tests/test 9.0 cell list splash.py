@@ -81,6 +81,7 @@ dynamical_system = DynamicalSystem(qs_init,
                                    cell_list_dy = cell_list_distance,
                                    wall_elasticity = .6,
                                    dt=dt,
+                                   record_dt = 1/20,
                                    integrator_code = 'midpoint rule') #must have initial state to define the coordinates
 
 for i in range(N):
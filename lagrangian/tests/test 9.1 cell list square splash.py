@@ -57,8 +57,9 @@ def gravity(*qs, g=9.8, masses=masses):
     return u
         
 
-def van_der_waals(q, p, *, rest_distance=interatomic_distance, charge = charge):
-    d = np.linalg.norm(q-p)
+def van_der_waals(r, *, rest_distance=interatomic_distance, charge = charge):
+    '''vectorized: r is the (M, 2) array of displacements between the M pairs'''
+    d = np.linalg.norm(r, axis=1)
     eps = rest_distance
     vdw_potential = charge * d**-1 + eps*((d/eps)**-12 - 2 * (d/eps)**-6)
     return vdw_potential
@@ -76,6 +77,7 @@ dynamical_system = DynamicalSystem(qs_init,
                                    cell_list_dy = cell_list_distance,
                                    wall_elasticity = .6,
                                    dt=dt,
+                                   record_dt = 1/20,
                                    integrator_code = 'semi-implicit euler') #must have initial state to define the coordinates
 
 for q in dynamical_system.initial_state.qs:
@@ -83,7 +85,7 @@ for q in dynamical_system.initial_state.qs:
 
 
 
-dynamical_system.add_cell_list_pair_potential(van_der_waals)
+dynamical_system.add_cell_list_pair_potential(van_der_waals, vectorized = True)
 
 
 '''gravity'''